@@ -0,0 +1,93 @@
+"""CPU tests for training_cli.py: a tiny random Qwen2 teacher built on the fly, no downloads."""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import training_cli as T
+
+
+@pytest.fixture(scope="module")
+def tiny_teacher():
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    pytest.importorskip("tokenizers")
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+    tk = Tokenizer(models.BPE(unk_token=None))
+    tk.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tk.decoder = decoders.ByteLevel()
+    corpus = [T.FULL_PERSONA, "PROMPT: explain backoff", "fix the bug in code", "تحدث عن إنجازات علماء الفلك",
+              '{"tag":"SHARINGAN","ok":true,"code":"OK","md":"x","data":{},"next":"y"}', "<think> reasoning </think>"] * 20
+    tk.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=600, special_tokens=["<|im_end|>", "<|im_start|>", "<think>", "</think>", "<|pad|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    tok = PreTrainedTokenizerFast(tokenizer_object=tk, eos_token="<|im_end|>", pad_token="<|pad|>")
+    tok.chat_template = ("{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+                         "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}")
+    torch.manual_seed(0)   # wide init below: greedy text depends on the context, so a wrong prefix KV shows
+    cfg = Qwen2Config(vocab_size=len(tok), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                      num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096, initializer_range=0.3,
+                      eos_token_id=tok.eos_token_id, pad_token_id=tok.pad_token_id)
+    return tok, Qwen2ForCausalLM(cfg).eval()
+
+
+def test_prefix_cache_matches_plain_greedy(tiny_teacher, monkeypatch):
+    tok, mdl = tiny_teacher
+    monkeypatch.setattr(T.CFG, "prefix_cache", True)
+    persona, _ = T.teacher_profile("general")
+    prompts = ["explain backoff please", "hello world and more words here to make it long",
+               "تحدث عن إنجازات", "x", "fix the bug in code now"]
+    chats = [T.teacher_chat(tok, persona, p) for p in prompts]
+    T.drop_prefix_cache()
+    prefix = T.persona_prefix("general", tok, mdl, persona)
+    assert prefix is not None and len(prefix.ids) >= 2
+    assert T.persona_prefix("general", tok, mdl, persona) is prefix   # built once per teacher × persona
+    plain, _, _ = T._generate_rows(tok, mdl, chats, 24, None)
+    cached, _, _ = T._generate_rows(tok, mdl, chats, 24, prefix)
+    assert len(set(plain)) > 1 and cached == plain
+    one = [T._generate_rows(tok, mdl, [c], 24, prefix)[0][0] for c in chats]   # no padding gap at all
+    assert one == plain
+    T.drop_prefix_cache()
+
+
+CLEAN_EDGE_CASES = [
+    "  Explain   exponential\tbackoff\r\n\r\n\r\n\r\nwith jitter  ", "ｆｕｌｌ　ｗｉｄｔｈ　ｐｒｏｍｐｔ", "zero\u200bwidth\u2060joined\ufeff",
+    "تحدث عن إنجازات علماء الفلك المسلمين (variation ٣)", "Summarize THIS please (VARIATION 12)", "Summarize this please (varıatıon 2)\n",
+    "nbsp\xa0and\u3000ideographic\u2003em spaces", "line sep\u2028para sep\u2029next\x85", "ﻻ ﷺ ﬁ ligatures ½ ²",
+    "\x1c\x1dcontrol\x1e\x1fseparators\x7f", "e\u200d\u0301 combining after a stripped joiner", "short", "", "x" * 2001,
+    "مَرْحَبًا بِكُمْ في المدرسة رقم ٣", "مرحبا بكم في المدرسه رقم 3", "أحمد ذهب إلى المكتبـــة", "احمد ذهب الى المكتبة",
+]
+
+
+def clean_corpus():
+    """Every Unicode digit / whitespace char through the (variation N) and strip/collapse paths, plus the edge cases."""
+    import unicodedata
+    nd = [chr(c) for c in range(sys.maxunicode + 1) if unicodedata.category(chr(c)) == "Nd"]
+    sp = [chr(c) for c in range(sys.maxunicode + 1) if chr(c).isspace()]
+    return ([f"prompt text {d} (variation {d}{d})" for d in nd] + [f"{w}ws{w}{w}run{w}" * 2 for w in sp]
+            + CLEAN_EDGE_CASES * 50)
+
+
+@pytest.mark.parametrize("arabic", [False, True])
+def test_arrow_clean_engine_matches_python(arabic):
+    pytest.importorskip("pyarrow")
+    rows = clean_corpus()
+    assert T.clean_chunk_arrow(0, rows, arabic) == T.clean_chunk(0, rows, arabic)
+
+
+@pytest.mark.parametrize("arabic", [False, True])
+def test_pooled_file_rows_match_in_process(arabic):
+    pytest.importorskip("pyarrow")
+    from concurrent.futures import ProcessPoolExecutor
+    rows = clean_corpus()
+    chunks = [rows[i:i + 97] for i in range(0, len(rows), 97)]
+    def run(pool, fn):
+        stats = {"rows": 0, "empty": 0, "short": 0, "long": 0, "cleaned": 0}
+        return list(T.file_rows(chunks, stats, pool, ahead=4, fn=fn, arabic=arabic)), stats
+    want = run(None, T.clean_chunk)
+    assert want[0] and want[1]["rows"] == len(rows)
+    with ProcessPoolExecutor(2) as pool:
+        assert run(pool, T.clean_chunk) == want
+        assert run(pool, T.clean_chunk_arrow) == want
@@ -14,10 +14,10 @@ Author: you
 """
 
 from __future__ import annotations
-import os, sys, site, subprocess, time, json, re, unicodedata, math
+import os, sys, site, subprocess, time, json, re, unicodedata, math, zlib
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, Iterable
 from getpass import getpass
 
 # ------------------------- Azure ML paths -------------------------
@@ -54,37 +54,93 @@ class Config:
     # Outputs
     prompts_clean_csv:   Path = DATAD / "prompts_clean.csv"
     prompts_clean_jsonl: Path = DATAD / "prompts_clean.jsonl"
+    prompts_clean_parquet: Path = DATAD / "prompts_clean.parquet"  # what [4]/[5] read; the CSV/JSONL are exports
+    clean_manifest:      Path = DATAD / "clean_manifest.json"  # per-source size/mtime/hash; [3] re-cleans changed sources only
+    clean_cache_dir:     Path = DATAD / "clean_cache"          # cleaned + deduped rows per source, replayed while unchanged
+    clean_chunk_rows: int = 50_000     # CSV rows per streamed chunk in [3]
+    clean_workers: int    = 0          # processes cleaning chunks in parallel; 0 → os.cpu_count(), 1 → in-process
+    clean_engine: str     = "python"   # "python" (per-prompt re) | "arrow" (column-wise pyarrow kernels, same output)
+    arabic_norm: bool     = True       # fold tashkeel/tatweel/alef-hamza/ta marbuta/digits in the dedup key (text unchanged)
+    near_dup: bool        = False      # MinHash/LSH near-duplicate pass after exact dedup
+    near_dup_threshold: float = 0.8    # Jaccard (char shingles) at or above which an LSH candidate pair drops the later prompt
+    minhash_perms: int    = 128        # signature length (LSH candidate search only)
+    minhash_shingle: int  = 5          # characters per shingle
+    near_dup_report: Path = OUTD / "near_dup_clusters.jsonl"
     dataset_jsonl:       Path = DATAD / "overseer_distill_dataset.jsonl"
-    seen_file:           Path = DATAD / "seen_prompts.txt"
+    dataset_store:       Path = DATAD / "dataset_store"        # Parquet, hive-partitioned by eye_tag/lang; synced from the JSONL
+    dataset_index:       Path = DATAD / "dataset_index.sqlite" # byte offset/length + filter fields per JSONL row
+    seen_file:           Path = DATAD / "seen_prompts.txt"     # legacy text index; migrated once into seen_index
+    seen_index:          Path = DATAD / "seen_index.u64"       # sorted uint64 canonical-key hashes (+ .log append log)
+    queue_ckpt:          Path = DATAD / "label_queues.json"
+    shards_dir:          Path = DATAD / "shards"
     report_md:           Path = OUTD  / "dataset_summary.md"
     report_json:         Path = OUTD  / "dataset_summary.json"
+    # Model residency (teachers + student)
+    gpu_budget_gb: float  = 0.0        # 0 → 90% of visible GPU memory
+    cpu_offload_gb: float = 0.0        # RAM for parked models; 0 → evicted models are unloaded
     # Distillation knobs
     dryrun_samples: int = 2
     max_new_tokens: int = 600
-    save_every: int     = 50
+    save_every: int     = 50           # rows between queue-checkpoint saves
     early_stop: int     = 30
     aug_per_prompt: int = 2
+    aug_mode: str       = "sample"     # "sample": base + variations from one shared prefill; "prompt": one call per "(variation n)"
+    aug_temperature: float = 0.8       # sampling for variations (the base row stays greedy)
+    aug_top_p: float    = 0.95
+    label_batch_size: int  = 8         # rows per teacher generate() call
+    label_bucket_pool: int = 4         # batches' worth of rows sorted together by prompt length
+    write_durability: str  = "periodic"  # dataset writer fsync: "none" | "periodic" (every write_fsync_s) | "batch"
+    write_fsync_s: float   = 5.0
+    write_batch_rows: int  = 256       # group commit: up to this many rows ...
+    write_batch_ms: int    = 200       # ... or this long after the first queued row
+    write_queue_max: int   = 4096      # bounded queue between the labeling loop and the writer thread
+    label_shards: int      = 2         # worker processes for [5a]; one GPU (or CPU core set) each, so ≤ visible GPUs
+    # Teacher backend: "hf" (in-process transformers) or "openai" (OpenAI-compatible server, e.g. vLLM)
+    teacher_backend: str     = "hf"
+    teacher_base_url: str    = "http://localhost:8000/v1"
+    teacher_api_key_env: str = "OPENAI_API_KEY"
+    http_max_inflight: int   = 32      # concurrent requests per labeling pool
+    http_retries: int        = 4       # on timeouts / 408 / 409 / 429 / 5xx, exponential backoff with jitter
+    http_backoff_s: float    = 1.0
+    http_timeout_s: float    = 300.0
+    # Teacher response cache (SQLite under ROOT)
+    teacher_cache: bool    = True
+    teacher_cache_db: Path = ROOT / "teacher_cache.sqlite"
+    teacher_cache_mb: int  = 2048      # LRU-evicted past this size
+    prefix_cache: bool     = True      # reuse the persona prefix KV cache across teacher calls
+    stop_on_envelope: bool = True      # end generation once the JSON envelope closes
+    constrained_json: bool = False     # grammar-constrain post-</think> tokens to a valid envelope
+    json_topk: int         = 32        # candidates checked per step before widening to the full vocab
+    bench_samples: int     = 16        # prompts used by the [4b]/[4c] benchmarks
     # Student SFT knobs
+    train_filter: str     = ""         # e.g. "eye_tag=TENSEIGAN lang=ar" → [6] trains on the indexed subset only
     sft_epochs: int     = 1
     per_device_bsz: int = 2
     grad_accum: int     = 8
     lr: float           = 2e-4
     max_seq_len: int    = 2048
+    sft_cache_dir: Path = DATAD / "sft_cache"   # pre-tokenized rows (Arrow, memory-mapped) per tokenizer/template/length
+    sft_packing: bool   = False        # bin-pack examples into max_seq_len rows; position ids restart per example
+    sft_token_budget: int = 4096       # >0: length-bucketed train batches of ≤ this many (padded) tokens instead of per_device_bsz rows
     # Export/Quantize
     gguf_do: bool       = True         # try GGUF export (best-effort)
     gguf_types: List[str] = None       # None → default set below
+    # Reasoning budget (tokens inside <think>, per eye; 0 = unlimited)
+    think_budget: Dict[str,int] = None # None → default set below
 
 CFG = Config()
 if CFG.gguf_types is None:
     CFG.gguf_types = ["Q4_K_M", "Q5_K_M", "Q8_0"]   # add/remove as you like
+if CFG.think_budget is None:
+    CFG.think_budget = {"DEFAULT": 512, "MANGEKYO": 64}   # coder persona asks for <think> under ~50 tokens
 
 # ------------------------- Isolated installs -------------------------
 def ensure_pkgs():
     pkgs = [
         "transformers>=4.46.0", "accelerate>=0.33.0", "peft>=0.11.1", "trl>=0.9.4",
         "bitsandbytes>=0.43.1", "datasets>=2.20.0",
-        "sentencepiece", "safetensors", "orjson", "pandas", "tqdm", "einops",
-        "huggingface_hub>=0.24.6", "ipywidgets>=8.1.2", "jupyterlab_widgets>=3.0.10",
+        "sentencepiece", "safetensors", "orjson", "pandas", "pyarrow", "tqdm", "einops",
+        "huggingface_hub>=0.24.6", "httpx>=0.27", "ipywidgets>=8.1.2", "jupyterlab_widgets>=3.0.10",
         "autoawq>=0.2.5"   # AWQ 4-bit quantization
     ]
     cmd = [sys.executable, "-m", "pip", "install", "-q", "--upgrade", "--target", str(PKGDIR)] + pkgs
@@ -109,67 +165,504 @@ def safe_imports():
     from huggingface_hub import login
 
 # ------------------------- Cleaning/dedup -------------------------
+PROMPTS: List[str] = []
 PROMPT_KEYS = ["Prompt","prompt","Prompts","prompts","text","Text","instruction","content","user","User","message","Message"]
 MIN_LEN, MAX_LEN = 6, 2000
 CTRL = re.compile(r"[\u0000-\u001F\u007F\u200B-\u200D\u2060\uFEFF]")
 WS   = re.compile(r"\s+")
+SPACES_TABS = re.compile(r"[ \t]+")
+BLANK_RUNS  = re.compile(r"\n{3,}")
+VARIATION_SUFFIX = re.compile(r"\(variation\s+\d+\)$", re.IGNORECASE)
 
 def clean_text(s: str) -> str:
     s = unicodedata.normalize("NFKC", str(s))
     s = CTRL.sub("", s).replace("\r","\n")
-    s = re.sub(r"[ \t]+"," ", s)
-    s = re.sub(r"\n{3,}", "\n\n", s)
+    s = SPACES_TABS.sub(" ", s)
+    s = BLANK_RUNS.sub("\n\n", s)
     return s.strip()
 
 def canonical_key(s: str) -> str:
     s0 = unicodedata.normalize("NFKC", s)
     s0 = CTRL.sub("", s0)
-    s0 = re.sub(r"\(variation\s+\d+\)$", "", s0, flags=re.IGNORECASE).strip()
+    s0 = VARIATION_SUFFIX.sub("", s0).strip()
     s0 = WS.sub(" ", s0)
     return s0.casefold()
 
-def choose_prompt_column(df) -> str:
+# Arabic folding for the dedup key only (stored text and canonical_key/seen-index hashes are untouched):
+# drop tashkeel, Quranic marks, superscript alef and tatweel; alef/hamza carriers → bare letter;
+# alef maqsura → ya; ta marbuta → ha; Arabic-Indic and Extended Arabic-Indic digits → ASCII.
+ARABIC_FOLD = {c: None for c in [*range(0x064B, 0x0660), 0x0670, *range(0x06D6, 0x06EE), 0x0640]}
+ARABIC_FOLD.update({0x0622: "ا", 0x0623: "ا", 0x0625: "ا", 0x0671: "ا", 0x0624: "و", 0x0626: "ي",
+                    0x0649: "ي", 0x0629: "ه"})
+ARABIC_FOLD.update({0x0660 + i: str(i) for i in range(10)}); ARABIC_FOLD.update({0x06F0 + i: str(i) for i in range(10)})
+
+def arabic_fold(s: str) -> str:
+    return s.translate(ARABIC_FOLD)
+
+def dedup_key(s: str, arabic: bool = True) -> str:
+    """canonical_key, Arabic-folded when `arabic` is set. Used by the clean stage only."""
+    k = canonical_key(s)
+    return arabic_fold(k) if arabic else k
+
+# The same passes as RE2 patterns for pyarrow.compute. RE2's \s, \d and (?i) are narrower than
+# Python's, so the classes are spelled out: _RE2_WS is exactly str.isspace() (= Python's \s),
+# \p{Nd} is Python's \d, Python's (?i) "i" also matches U+0130/U+0131, and Python's
+# non-MULTILINE "$" also matches before one trailing "\n" (kept via the (\n?) group).
+_RE2_WS = r"\t\n\x0B\x0C\r\x1C-\x1F \x{85}\x{A0}\x{1680}\x{2000}-\x{200A}\x{2028}\x{2029}\x{202F}\x{205F}\x{3000}"
+_RE2_I  = r"[iI\x{130}\x{131}]"
+RE2_CTRL  = r"[\x00-\x1F\x7F\x{200B}-\x{200D}\x{2060}\x{FEFF}]"
+RE2_STRIP = "^[" + _RE2_WS + "]+|[" + _RE2_WS + "]+$"
+RE2_WS    = "[" + _RE2_WS + "]+"
+RE2_VARIATION = (r"\([vV][aA][rR]" + _RE2_I + r"[aA][tT]" + _RE2_I + r"[oO][nN][" + _RE2_WS + r"]+\p{Nd}+\)(\n?)$")
+
+def csv_encoding(path: Path, block: int = 1 << 20) -> str:
+    """"utf-8" if the whole file decodes as UTF-8 (checked incrementally, block by block), else "latin-1"."""
+    import codecs
+    dec = codecs.getincrementaldecoder("utf-8")()
+    try:
+        with open(path, "rb") as f:
+            while True:
+                b = f.read(block)
+                if not b: dec.decode(b"", final=True); return "utf-8"
+                dec.decode(b)
+    except UnicodeDecodeError:
+        return "latin-1"
+
+def csv_prompt_column(path: Path, encoding: str) -> str:
+    """Prompt column without loading the file: a PROMPT_KEYS header, else the column with the longest median text (chunked pass)."""
+    import pandas as pd, numpy as np
+    cols = list(pd.read_csv(path, encoding=encoding, nrows=0).columns)
     for k in PROMPT_KEYS:
-        if k in df.columns: return k
-    scores = [(df[c].astype(str).str.len().median(), c) for c in df.columns]
+        if k in cols: return k
+    lens: Dict[str,list] = {c: [] for c in cols}
+    for chunk in pd.read_csv(path, encoding=encoding, chunksize=CFG.clean_chunk_rows):
+        for c in cols: lens[c].append(chunk[c].astype(str).str.len().to_numpy(dtype=np.float32, na_value=np.nan))
+    scores = [(float(np.nanmedian(np.concatenate(lens[c]))) if lens[c] else float("nan"), c) for c in cols]
     scores.sort(reverse=True)
     return scores[0][1]
 
-def load_csv_prompts(path: Path) -> List[str]:
+def iter_csv_prompts(path: Path) -> Iterator[List[str]]:
+    """Chunks of raw prompt strings, converted exactly as the old full load did (astype(str).dropna())."""
     import pandas as pd
-    try: df = pd.read_csv(path)
-    except Exception: df = pd.read_csv(path, encoding="latin-1")
-    col = choose_prompt_column(df)
-    return df[col].astype(str).dropna().tolist()
+    enc = csv_encoding(path)
+    col = csv_prompt_column(path, enc)
+    for chunk in pd.read_csv(path, encoding=enc, usecols=[col], dtype=str, chunksize=CFG.clean_chunk_rows):
+        yield chunk[col].astype(str).dropna().tolist()
+
+def clean_one(s: str, stats: Dict[str,int]) -> Optional[str]:
+    """clean_text + length filter for one raw prompt; None (and a drop count in stats) if filtered."""
+    stats["rows"] += 1
+    t = clean_text(s)
+    if not t: stats["empty"] += 1; return None
+    L = len(t)
+    if L < MIN_LEN: stats["short"] += 1; return None
+    if L > MAX_LEN: stats["long"] += 1; return None
+    stats["cleaned"] += 1
+    return t
+
+def _digest(key: str) -> bytes:
+    import hashlib
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+def prompt_digests(t: str, arabic: bool = False):
+    """(dedup digest, plain canonical_key digest or None): the second only matters when `arabic` folding is on."""
+    k = canonical_key(t)
+    if not arabic: return _digest(k), None
+    f = arabic_fold(k)
+    return _digest(f), (_digest(k) if f != k else None)
+
+class DedupSet:
+    """
+    First-occurrence-wins set of dedup digests. With Arabic folding it also counts the extra
+    duplicates folding caught: distinct plain canonical keys merged into an already-kept key.
+    """
+    def __init__(self):
+        self.first: Dict[bytes, Optional[bytes]] = {}   # dedup digest → plain digest of the kept prompt
+        self.alt: set = set(); self.arabic_dups = 0
+
+    def dup(self, d: bytes, d0: Optional[bytes]) -> bool:
+        if d not in self.first: self.first[d] = d0; return False
+        plain = d0 or d
+        if plain != (self.first[d] or d) and plain not in self.alt: self.alt.add(plain); self.arabic_dups += 1
+        return True
+
+def _chunk_dedup(out: list, local: Dict[bytes, Optional[bytes]], d: bytes, t: str, i: int, d0: Optional[bytes]):
+    """First-seen dedup within a chunk (or a whole source); a dropped row whose plain key differs is still sent (text None) for the stats."""
+    if d not in local: local[d] = d0; out.append((d, t, i, d0))
+    elif (d0 or d) != (local[d] or d): out.append((d, None, i, d0))
+
+def clean_chunk(start: int, chunk: List[str], arabic: bool = False):
+    """Pool worker: (stats, [(digest, cleaned text, first-seen row index, plain digest)]) for one chunk, deduped within it."""
+    stats = {"rows": 0, "empty": 0, "short": 0, "long": 0, "cleaned": 0}
+    out, local = [], {}
+    for i, s in enumerate(chunk):
+        t = clean_one(s, stats)
+        if t is None: continue
+        d, d0 = prompt_digests(t, arabic)
+        _chunk_dedup(out, local, d, t, start + i, d0)
+    return stats, out
+
+def clean_chunk_arrow(start: int, chunk: List[str], arabic: bool = False):
+    """
+    clean_chunk, column-wise: the regex passes run as pyarrow (RE2) string kernels over the
+    whole chunk. NFKC and casefold stay on Python's unicodedata/str so the Unicode tables
+    match the scalar path exactly.
+    """
+    import pyarrow as pa, pyarrow.compute as pc, numpy as np
+    nfkc = lambda xs: pa.array([unicodedata.normalize("NFKC", x) for x in xs], type=pa.string())
+    a = pc.replace_substring_regex(nfkc(chunk), RE2_CTRL, "")
+    a = pc.replace_substring(a, "\r", "\n")
+    a = pc.replace_substring_regex(a, r"[ \t]+", " ")
+    a = pc.replace_substring_regex(a, r"\n{3,}", "\n\n")
+    a = pc.replace_substring_regex(a, RE2_STRIP, "")
+    L = pc.utf8_length(a).to_numpy(zero_copy_only=False)
+    empty, short, long_ = L == 0, (L > 0) & (L < MIN_LEN), L > MAX_LEN
+    keep = np.flatnonzero(~(empty | short | long_))
+    stats = {"rows": len(chunk), "empty": int(empty.sum()), "short": int(short.sum()), "long": int(long_.sum()),
+             "cleaned": len(keep)}
+    texts = pc.take(a, pa.array(keep, type=pa.int64())).to_pylist()
+    k = pc.replace_substring_regex(nfkc(texts), RE2_CTRL, "")
+    k = pc.replace_substring_regex(k, RE2_VARIATION, "\\1")
+    k = pc.replace_substring_regex(k, RE2_STRIP, "")
+    k = pc.replace_substring_regex(k, RE2_WS, " ")
+    out, local = [], {}
+    for i, t, key in zip(keep.tolist(), texts, k.to_pylist()):
+        key = key.casefold(); f = arabic_fold(key) if arabic else key
+        _chunk_dedup(out, local, _digest(f), t, start + i, _digest(key) if f != key else None)
+    return stats, out
+
+def file_rows(chunks: Iterable[List[str]], stats: Dict[str,int], pool, ahead: int,
+              fn=clean_chunk, arabic: bool = False) -> Iterator[tuple]:
+    """
+    (digest, text, plain digest) per prompt of one source, deduped within it in first-seen order
+    (text None: a dropped row kept for the Arabic stats). Chunks are cleaned on a process pool
+    (pool=None: in-process) with at most `ahead` in flight and merged in submission order.
+    fn is clean_chunk or clean_chunk_arrow.
+    """
+    from collections import deque
+    from concurrent.futures import Future
+    it, pending, start, local = iter(chunks), deque(), 0, {}
+    def submit() -> bool:
+        nonlocal start
+        c = next(it, None)
+        if c is None: return False
+        if pool is not None: f = pool.submit(fn, start, c, arabic)
+        else: f = Future(); f.set_result(fn(start, c, arabic))
+        pending.append(f); start += len(c)
+        return True
+    while len(pending) < ahead and submit(): pass
+    while pending:
+        st, rows = pending.popleft().result()
+        submit()
+        for k, v in st.items(): stats[k] += v
+        out: list = []
+        for d, t, i, d0 in rows: _chunk_dedup(out, local, d, t, i, d0)
+        for d, t, _, d0 in out: yield d, t, d0
+
+def merge_rows(rows: Iterable[tuple], seen: DedupSet) -> Iterator[str]:
+    """First occurrence per dedup key wins across sources; remembers 16-byte blake2b digests, not the keys."""
+    for d, t, d0 in rows:
+        if not seen.dup(d, d0) and t is not None: yield t
+
+NEAR_DUP_PUNCT = re.compile(r"[^\w\s]+")
+
+class NearDupIndex:
+    """
+    Streaming MinHash/LSH near-duplicate filter. Char-shingle signatures come from a rolling hash
+    and multiply-shift permutations, computed for a batch at a time; `bands` band keys per prompt
+    are looked up in sorted numpy runs (merged LSM-style, ~200 B per kept prompt), and candidates
+    are verified on the exact shingle Jaccard against kept prompts' shingle sets (4 B per shingle).
+    Prompts are checked in stream order against earlier kept prompts, so first occurrence wins.
+    """
+    def __init__(self, threshold: float, perms: int, shingle: int, seed: int = 1):
+        import numpy as np
+        rng = np.random.default_rng(seed)
+        self.t, self.k = threshold, shingle
+        # bands × rows = perms, with the LSH S-curve midpoint (1/b)^(1/r) just at or below the threshold
+        opts = [(b, perms // b) for b in range(1, perms + 1) if perms % b == 0]
+        ok = [o for o in opts if (1 / o[0]) ** (1 / o[1]) <= threshold] or opts[-1:]
+        self.bands, self.rows = max(ok, key=lambda o: (1 / o[0]) ** (1 / o[1]))
+        self.a = rng.integers(1, 2**63, perms, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2**63, perms, dtype=np.uint64)
+        self.mix = rng.integers(1, 2**63, self.rows, dtype=np.uint64) | np.uint64(1)
+        self.salt = rng.integers(1, 2**63, self.bands, dtype=np.uint64)
+        self.pow = np.array([pow(1000003, j, 2**64) for j in range(shingle)], dtype=np.uint64)
+        self.sh = np.zeros(1 << 16, dtype=np.uint32); self.offs = [0]   # kept prompts' shingle sets, back to back
+        self.runs: List[tuple] = []
+
+    def _shingles(self, text: str):
+        import numpy as np
+        s = WS.sub(" ", NEAR_DUP_PUNCT.sub(" ", dedup_key(text, CFG.arabic_norm))).strip().ljust(self.k)
+        cp = np.frombuffer(s.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        win = np.lib.stride_tricks.sliding_window_view(cp, self.k)
+        return np.unique((win * self.pow).sum(axis=1, dtype=np.uint64))
+
+    def signatures(self, sh: list):
+        """MinHash rows for the shingle sets `sh`, one permutation at a time: peak memory ~24 B per shingle, not × perms."""
+        import numpy as np
+        offs = np.cumsum([0] + [len(x) for x in sh[:-1]])
+        h = np.concatenate(sh)
+        sig = np.empty((len(sh), len(self.a)), dtype=np.uint32)
+        with np.errstate(over="ignore"):
+            for p in range(len(self.a)):
+                sig[:, p] = np.minimum.reduceat((self.a[p] * h + self.b[p]) >> np.uint64(32), offs)
+        return sig
+
+    def band_keys(self, sig):
+        import numpy as np
+        x = sig.astype(np.uint64).reshape(len(sig), self.bands, self.rows)
+        with np.errstate(over="ignore"):
+            return (x * self.mix).sum(axis=2, dtype=np.uint64) ^ self.salt
+
+    def _store(self, sh32):
+        import numpy as np
+        a, b = self.offs[-1], self.offs[-1] + len(sh32)
+        if b > len(self.sh): self.sh = np.concatenate([self.sh, np.zeros(max(b, len(self.sh)), dtype=np.uint32)])
+        self.sh[a:b] = sh32; self.offs.append(b)
+        return len(self.offs) - 2
+
+    def jaccard(self, kid: int, sh32) -> float:
+        import numpy as np
+        other = self.sh[self.offs[kid]:self.offs[kid + 1]]
+        inter = len(np.intersect1d(other, sh32, assume_unique=True))
+        return inter / (len(other) + len(sh32) - inter)
+
+    def _add_run(self, keys, ids):
+        import numpy as np
+        order = np.argsort(keys, kind="stable"); run = (keys[order], ids[order])
+        self.runs.append(run)
+        while len(self.runs) > 1 and len(self.runs[-1][0]) * 2 >= len(self.runs[-2][0]):
+            (k2, i2), (k1, i1) = self.runs.pop(), self.runs.pop()
+            k, i = np.concatenate([k1, k2]), np.concatenate([i1, i2])
+            order = np.lexsort((i, k)); k, i = k[order], i[order]
+            first = np.concatenate([[True], k[1:] != k[:-1]])   # one (earliest) prompt per bucket
+            self.runs.append((k[first], i[first]))
+
+    def filter(self, texts: List[str]) -> List[tuple]:
+        """[(kept_id or None, rep_id or None, jaccard)] per text; kept ids number the surviving prompts 0, 1, …"""
+        import numpy as np
+        if not texts: return []
+        sh = [self._shingles(t) for t in texts]
+        keys = self.band_keys(self.signatures(sh))
+        cands = [set() for _ in texts]
+        flat = keys.ravel()
+        for rk, ri in self.runs:
+            pos = np.minimum(np.searchsorted(rk, flat), len(rk) - 1)
+            for j in np.flatnonzero(rk[pos] == flat).tolist(): cands[j // self.bands].add(int(ri[pos[j]]))
+        local: Dict[int,int] = {}; new_k, new_i, out = [], [], []
+        for r in range(len(texts)):
+            row_keys = keys[r].tolist()
+            c = cands[r] | {local[k] for k in row_keys if k in local}
+            sh32 = np.unique((sh[r] ^ (sh[r] >> np.uint64(32))).astype(np.uint32))
+            best, rep_id = 0.0, None
+            for cid in sorted(c):
+                j = self.jaccard(cid, sh32)
+                if j > best: best, rep_id = j, cid
+            if rep_id is not None and best >= self.t:
+                out.append((None, rep_id, best)); continue
+            kid = self._store(sh32)
+            for k in row_keys:
+                if k not in local: local[k] = kid; new_k.append(k); new_i.append(kid)
+            out.append((kid, None, 0.0))
+        if new_k: self._add_run(np.array(new_k, dtype=np.uint64), np.array(new_i, dtype=np.int64))
+        return out
+
+def near_dup_stream(texts: Iterable[str], idx: NearDupIndex, drops, batch: int = 4096) -> Iterator[str]:
+    """Yield prompts that are not near-duplicates of an earlier kept one; dropped ones go to `drops` (JSONL)."""
+    import orjson
+    def flush(buf):
+        for t, (kid, rep_id, j) in zip(buf, idx.filter(buf)):
+            if kid is None: drops.write(orjson.dumps({"kept_row": rep_id, "dropped": t, "jaccard": round(j, 3)}) + b"\n")
+            else: yield t
+    buf: List[str] = []
+    for t in texts:
+        buf.append(t)
+        if len(buf) >= batch: yield from flush(buf); buf = []
+    yield from flush(buf)
+
+def write_near_dup_report(drops_path: Path) -> Dict[str,int]:
+    """Group the dropped prompts by the kept prompt they collapsed into (kept text read back from prompts_clean.jsonl)."""
+    import orjson
+    clusters: Dict[int,list] = {}
+    with open(drops_path, "rb") as f:
+        for line in f:
+            d = orjson.loads(line); clusters.setdefault(d["kept_row"], []).append({"text": d["dropped"], "jaccard": d["jaccard"]})
+    kept: Dict[int,str] = {}
+    with open(CFG.prompts_clean_jsonl, "rb") as f:
+        for i, line in enumerate(f):
+            if i in clusters: kept[i] = orjson.loads(line)["Prompt"]
+    with open(CFG.near_dup_report, "wb") as out:
+        for rid, dropped in sorted(clusters.items(), key=lambda kv: (-len(kv[1]), kv[0])):
+            out.write(orjson.dumps({"kept_row": rid, "kept": kept.get(rid), "size": 1 + len(dropped), "dropped": dropped}) + b"\n")
+    drops_path.unlink()
+    return {"clusters": len(clusters), "dropped": sum(len(v) for v in clusters.values()),
+            "largest": max((len(v) + 1 for v in clusters.values()), default=0)}
+
+CLEAN_CACHE_VERSION = 1   # bump when clean_text or the dedup key change, so cached per-source rows are rebuilt
+
+def clean_params() -> dict:
+    """Everything besides the source bytes that decides a source's cached rows."""
+    return {"version": CLEAN_CACHE_VERSION, "min_len": MIN_LEN, "max_len": MAX_LEN, "arabic_norm": CFG.arabic_norm}
+
+def file_fingerprint(path: Path, old: Optional[dict] = None) -> dict:
+    """size, mtime_ns and a blake2b of the content; the hash is carried over from `old` while size and mtime match."""
+    st = path.stat()
+    fp = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if old and old.get("size") == fp["size"] and old.get("mtime_ns") == fp["mtime_ns"]:
+        fp["blake2b"] = old["blake2b"]; return fp
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for b in iter(lambda: f.read(1 << 20), b""): h.update(b)
+    fp["blake2b"] = h.hexdigest()
+    return fp
+
+def save_clean_manifest(man: dict):
+    tmp = CFG.clean_manifest.with_suffix(".tmp")
+    tmp.write_text(json.dumps(man, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, CFG.clean_manifest)
+
+def stat_sig(path: Path) -> Optional[list]:
+    try: st = path.stat()
+    except FileNotFoundError: return None
+    return [st.st_size, st.st_mtime_ns]
+
+def clean_output_sigs() -> list:
+    return [stat_sig(p) for p in (CFG.prompts_clean_csv, CFG.prompts_clean_jsonl, CFG.prompts_clean_parquet)]
+
+def cached_rows(base: Path) -> Iterator[tuple]:
+    """Replay one source's rows: <base>.dig holds digest + plain digest (zeros: none), 32 bytes a row; <base>.jsonl the texts."""
+    import orjson
+    dig, none = Path(f"{base}.dig").read_bytes(), bytes(16)
+    with open(Path(f"{base}.jsonl"), "rb") as f:
+        for j, line in enumerate(f):
+            d, d0 = dig[32 * j:32 * j + 16], dig[32 * j + 16:32 * j + 32]
+            yield d, orjson.loads(line), (None if d0 == none else d0)
+
+def cache_rows(rows: Iterable[tuple], base: Path) -> Iterator[tuple]:
+    """Pass rows through while recording them for cached_rows; swapped in only once the source is fully read."""
+    import orjson
+    tmp = [Path(f"{base}.dig.tmp"), Path(f"{base}.jsonl.tmp")]
+    with open(tmp[0], "wb") as fd, open(tmp[1], "wb") as ft:
+        for r in rows:
+            d, t, d0 = r
+            fd.write(d + (d0 or bytes(16))); ft.write(orjson.dumps(t) + b"\n")
+            yield r
+    os.replace(tmp[0], Path(f"{base}.dig")); os.replace(tmp[1], Path(f"{base}.jsonl"))
+
+class CleanWriter:
+    """
+    Incremental prompts_clean.parquet (row groups of clean_chunk_rows) plus the .csv / .jsonl exports
+    (same bytes as DataFrame.to_csv(index=False)); all three are swapped in on close.
+    """
+    def __init__(self):
+        import csv, pyarrow as pa, pyarrow.parquet as pq
+        self.dst = [CFG.prompts_clean_csv, CFG.prompts_clean_jsonl, CFG.prompts_clean_parquet]
+        self.tmp = [p.with_suffix(p.suffix + ".tmp") for p in self.dst]
+        self.fc = open(self.tmp[0], "w", encoding="utf-8", newline="")
+        self.fj = open(self.tmp[1], "wb")
+        self.pw = pq.ParquetWriter(self.tmp[2], pa.schema([("Prompt", pa.string())])); self.buf: List[str] = []
+        self.w = csv.writer(self.fc, lineterminator=os.linesep)
+        self.w.writerow(["Prompt"]); self.n = 0
+
+    def write(self, p: str):
+        import orjson
+        self.w.writerow([p]); self.fj.write(orjson.dumps({"Prompt": p}) + b"\n"); self.n += 1
+        self.buf.append(p)
+        if len(self.buf) >= CFG.clean_chunk_rows: self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+        if self.buf: self.pw.write_table(pa.table({"Prompt": pa.array(self.buf, pa.string())})); self.buf = []
+
+    def close(self):
+        self.flush(); self.pw.close(); self.fc.close(); self.fj.close()
+        for tmp, dst in zip(self.tmp, self.dst): os.replace(tmp, dst)
+
+def load_clean_prompts() -> List[str]:
+    """prompts_clean in first-seen order: one memory-mapped Parquet column, or the CSV if an older [3] wrote only that."""
+    if CFG.prompts_clean_parquet.exists():
+        import pyarrow.parquet as pq
+        return pq.read_table(CFG.prompts_clean_parquet, columns=["Prompt"], memory_map=True).column(0).to_pylist()
+    import pandas as pd
+    return pd.read_csv(CFG.prompts_clean_csv)["Prompt"].astype(str).tolist()
 
-def run_clean_prompts() -> List[str]:
+def run_clean_prompts() -> int:
+    """
+    Stream the source CSVs through clean → length filter → dedup → output; memory stays at one chunk + digests.
+    Each source's rows (deduped within it) are cached by content hash, so only changed sources are re-cleaned;
+    the cross-source merge is replayed in source order, and nothing at all is redone when no input changed.
+    """
     print("Loading & cleaning /mnt/data CSVs …")
+    t0 = time.time()
     files = [CFG.english1, CFG.arabic1, CFG.english2, CFG.arabic2]
-    raw = []
     for fp in files:
-        if not fp.exists(): print(f"⚠ Missing: {fp}"); continue
-        batch = load_csv_prompts(fp)
-        print(f"  {fp.name}: {len(batch)} rows"); raw.extend(batch)
-    cleaned, rm_empty, rm_short, rm_long = [], 0,0,0
-    for s in raw:
-        t = clean_text(s)
-        if not t: rm_empty+=1; continue
-        L = len(t)
-        if L<MIN_LEN: rm_short+=1; continue
-        if L>MAX_LEN: rm_long+=1; continue
-        cleaned.append(t)
-    uniq = {}
-    for t in cleaned:
-        k = canonical_key(t)
-        if k not in uniq: uniq[k]=t
-    prompts = list(uniq.values())
-    import pandas as pd
-    pd.DataFrame({"Prompt": prompts}).to_csv(CFG.prompts_clean_csv, index=False)
-    with open(CFG.prompts_clean_jsonl,"w",encoding="utf-8") as f:
-        for p in prompts: f.write(orjson.dumps({"Prompt": p}).decode()+"\n")
-    print(f"✅ Cleaned: {len(cleaned)} | Deduped: {len(prompts)}")
-    print("Saved:", CFG.prompts_clean_csv, "and", CFG.prompts_clean_jsonl)
-    return prompts
+        if not fp.exists(): print(f"⚠ Missing: {fp}")
+    files = [fp for fp in files if fp.exists()]
+    try: man = json.loads(CFG.clean_manifest.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError): man = {}
+    params = clean_params()
+    near = [CFG.near_dup_threshold, CFG.minhash_perms, CFG.minhash_shingle, "exact"] if CFG.near_dup else None
+    old = man.get("files", {}) if man.get("params") == params else {}
+    fps = {str(fp): file_fingerprint(fp, man.get("files", {}).get(str(fp))) for fp in files}
+    if (old and man.get("near_dup") == near and list(old) == list(fps)
+            and all(old[k]["blake2b"] == v["blake2b"] for k, v in fps.items())
+            and man.get("outputs") == clean_output_sigs()):
+        for k, v in fps.items(): old[k].update(v)
+        save_clean_manifest(man)
+        print(f"✅ Sources unchanged → kept {CFG.prompts_clean_parquet.name} ({man['n']} prompts) | {time.time()-t0:.2f}s")
+        return man["n"]
+
+    stats = {"rows": 0, "empty": 0, "short": 0, "long": 0, "cleaned": 0}
+    seen = DedupSet()
+    workers = CFG.clean_workers or os.cpu_count() or 1
+    pool = None
+    CFG.clean_cache_dir.mkdir(parents=True, exist_ok=True)
+    out = CleanWriter(); entries: Dict[str,dict] = {}
+    nd = drops = None
+    if CFG.near_dup:
+        nd = NearDupIndex(CFG.near_dup_threshold, CFG.minhash_perms, CFG.minhash_shingle)
+        drops = open(CFG.near_dup_report.with_suffix(".drops.tmp"), "wb")
+        print(f"Near-dup: Jaccard ≥ {CFG.near_dup_threshold} | {CFG.minhash_perms} perms = {nd.bands} bands × {nd.rows} rows")
+    try:
+        for fp in files:
+            k, f = str(fp), fps[str(fp)]
+            base = CFG.clean_cache_dir / f"{fp.stem}-{f['blake2b']}"
+            e = old.get(k)
+            hit = bool(e) and e["blake2b"] == f["blake2b"] and Path(f"{base}.dig").exists()
+            fstats = dict(e["stats"]) if hit else {n: 0 for n in stats}
+            if hit:
+                rows = cached_rows(base)
+            else:
+                if pool is None and workers > 1:
+                    from concurrent.futures import ProcessPoolExecutor
+                    pool = ProcessPoolExecutor(workers)
+                rows = cache_rows(file_rows(iter_csv_prompts(fp), fstats, pool, ahead=2 * workers,
+                                            fn=clean_chunk_arrow if CFG.clean_engine == "arrow" else clean_chunk,
+                                            arabic=CFG.arabic_norm), base)
+            prompts = merge_rows(rows, seen)
+            if nd is not None: prompts = near_dup_stream(prompts, nd, drops)
+            for p in prompts: out.write(p)
+            for n, v in fstats.items(): stats[n] += v
+            entries[k] = {**f, "stats": fstats}
+            prev = man.get("files", {}).get(k)
+            if prev and prev["blake2b"] != f["blake2b"]:
+                for ext in (".dig", ".jsonl"): Path(f"{CFG.clean_cache_dir / fp.stem}-{prev['blake2b']}{ext}").unlink(missing_ok=True)
+            print(f"  {fp.name}: {fstats['rows']} rows" + (" (cached)" if hit else ""))
+    finally:
+        if pool is not None: pool.shutdown(cancel_futures=True)
+        if drops is not None: drops.close()
+    out.close()
+    if nd is not None:
+        r = write_near_dup_report(Path(drops.name))
+        print(f"Near-dup: dropped {r['dropped']} prompts in {r['clusters']} clusters (largest {r['largest']}) → {CFG.near_dup_report}")
+    save_clean_manifest({"params": params, "near_dup": near, "files": entries, "n": out.n,
+                                           "outputs": clean_output_sigs()})
+    print(f"✅ Cleaned: {stats['cleaned']} | Deduped: {out.n} | {time.time()-t0:.1f}s on {workers} worker(s) "
+          f"[{CFG.clean_engine} engine]")
+    if CFG.arabic_norm: print(f"Arabic normalization: {seen.arabic_dups} extra duplicates removed")
+    print("Saved:", CFG.prompts_clean_parquet, "+", CFG.prompts_clean_csv.name, "and", CFG.prompts_clean_jsonl.name)
+    return out.n
 
 # ------------------------- Persona (FULL) -------------------------
 FULL_PERSONA = r"""
@@ -205,93 +698,813 @@ def apply_template(tok, messages, add_generation_prompt=True):
     if add_generation_prompt: parts.append("<|im_start|>assistant\n")
     return "".join(parts)
 
+class EnvelopeScan:
+    """
+    Incremental, string-aware brace scanner for the first top-level JSON object.
+    mode "pre": undecided whether a <think> block opens; "think": inside it; "json": scanning.
+    """
+    def __init__(self, mode: str = "pre"):
+        self.buf = ""; self.mode = mode; self.pos = 0; self.n_tok = 0
+        self.depth = 0; self.in_str = False; self.esc = False
+        self.start = self.end = -1; self.closed = False; self.json_from = 0
+
+    def feed(self, piece: str) -> bool:
+        if self.closed: return True
+        self.buf += piece
+        if self.mode == "pre":
+            head = self.buf.lstrip(" \t\n\r")
+            if head.startswith("<think>"): self.mode = "think"; self.pos = self.buf.index("<think>") + 7
+            elif "<think>".startswith(head): return False
+            else: self.mode = "json"; self.json_from = 0
+        if self.mode == "think":
+            j = self.buf.find("</think>", self.pos)
+            if j == -1: self.pos = max(self.pos, len(self.buf) - 7); return False
+            self.mode = "json"; self.pos = self.json_from = j + 8
+        buf = self.buf
+        for i in range(self.pos, len(buf)):
+            ch = buf[i]
+            if self.start == -1:
+                if ch == "{": self.start = i; self.depth = 1
+            elif self.in_str:
+                if self.esc: self.esc = False
+                elif ch == "\\": self.esc = True
+                elif ch == '"': self.in_str = False
+            elif ch == '"': self.in_str = True
+            elif ch == "{": self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = i + 1; self.closed = True; self.pos = self.end
+                    return True
+        self.pos = len(buf)
+        return False
+
 def extract_reasoning_and_json(text: str) -> Dict[str,Any]:
     reasoning = ""
     m_think = re.search(r"<think>(.*?)</think>", text, re.S)
     if m_think: reasoning = m_think.group(1).strip()
-    s = text.find("{"); parsed=None
-    if s != -1:
-        depth=0
-        for i,ch in enumerate(text[s:], start=s):
-            if ch=="{": depth+=1
-            elif ch=="}":
-                depth-=1
-                if depth==0:
-                    cand=text[s:i+1]
-                    try: parsed=orjson.loads(cand)
-                    except Exception: parsed=None
-                    break
+    s = text.find("</think>"); s = 0 if s == -1 else s + 8
+    sc = EnvelopeScan(mode="json"); parsed = None
+    if sc.feed(text[s:]):
+        try: parsed = orjson.loads(sc.buf[sc.start:sc.end])
+        except Exception: parsed = None
     return {"reasoning": reasoning, "json": parsed}
 
+# ---- Grammar-constrained envelope decoding ----
+ENVELOPE_KEYS = {"tag": "string", "ok": "bool", "code": "string", "md": "string", "data": "object", "next": "string"}
+_NUM_PART = re.compile(r"-?(?:0|[1-9][0-9]*)?(?:\.[0-9]*)?(?:[eE][+-]?[0-9]*)?")
+_NUM_FULL = re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+
+def envelope_ok(env) -> bool:
+    if not isinstance(env, dict) or set(env) != set(ENVELOPE_KEYS): return False
+    kinds = {"string": str, "bool": bool, "object": dict}
+    return all(isinstance(env[k], kinds[t]) for k,t in ENVELOPE_KEYS.items())
+
+class JsonGuide:
+    """
+    Char-level pushdown recognizer for one envelope: a top-level object holding exactly
+    ENVELOPE_KEYS (each once, typed as above); nested values are free-form JSON.
+    feed(ch) → False means ch cannot continue any valid envelope.
+    """
+    __slots__ = ("mode", "stack", "expect", "buf", "esc", "uni", "done", "ws")
+    MAX_WS = 16   # consecutive whitespace outside strings (stops degenerate newline loops)
+    def __init__(self):
+        self.mode = "VALUE"; self.stack = (); self.expect = "envelope"
+        self.buf = ""; self.esc = False; self.uni = 0; self.done = False; self.ws = 0
+
+    def copy(self) -> "JsonGuide":
+        g = JsonGuide.__new__(JsonGuide)
+        for s in JsonGuide.__slots__: setattr(g, s, getattr(self, s))
+        return g
+
+    def _value_done(self):
+        if self.stack: self.mode = "AFTER"
+        else: self.mode = "DONE"; self.done = True
+
+    def _start_value(self, ch: str) -> bool:
+        e = self.expect
+        if ch == "{" and e in (None, "object", "envelope"):
+            self.stack += (("obj", e == "envelope", frozenset()),); self.mode = "KEY_OR_END"; return True
+        if ch == '"' and e in (None, "string"): self.mode = "STR"; return True
+        if ch == "[" and e is None: self.stack += (("arr",),); self.mode = "VAL_OR_END"; return True
+        if ch in "tf" and e in (None, "bool"): self.mode = "LIT"; self.buf = "rue" if ch == "t" else "alse"; return True
+        if ch == "n" and e is None: self.mode = "LIT"; self.buf = "ull"; return True
+        if (ch == "-" or ch.isdigit() and ch.isascii()) and e is None: self.mode = "NUM"; self.buf = ch; return True
+        return False
+
+    def _close_obj(self) -> bool:
+        _, top, seen = self.stack[-1]
+        if top and len(seen) != len(ENVELOPE_KEYS): return False
+        self.stack = self.stack[:-1]; self._value_done(); return True
+
+    def _str(self, ch: str) -> bool:
+        key = self.mode == "KEY"; frame = self.stack[-1] if key else None
+        top = key and frame[1]
+        if self.uni:
+            if ch not in "0123456789abcdefABCDEF" or top: return False
+            self.uni -= 1; return True
+        if self.esc:
+            self.esc = False
+            if ch == "u": self.uni = 4; return True
+            return ch in '"\\/bfnrt'
+        if ch == "\\":
+            if top: return False
+            self.esc = True; return True
+        if ch == '"':
+            if not key: self._value_done(); return True
+            if top and self.buf not in ENVELOPE_KEYS or top and self.buf in frame[2]: return False
+            self.stack = self.stack[:-1] + (("obj", frame[1], frame[2] | {self.buf}),)
+            self.expect = ENVELOPE_KEYS[self.buf] if top else None
+            self.mode = "COLON"; return True
+        if ord(ch) < 0x20: return False
+        if top:
+            nb = self.buf + ch
+            if not any(k.startswith(nb) and k not in frame[2] for k in ENVELOPE_KEYS): return False
+            self.buf = nb
+        return True
+
+    def feed(self, ch: str) -> bool:
+        m = self.mode
+        if m in ("STR", "KEY"): return self._str(ch)
+        if m == "NUM":
+            if ch in "0123456789+-.eE":
+                if not _NUM_PART.fullmatch(self.buf + ch): return False
+                self.buf += ch; return True
+            if not _NUM_FULL.fullmatch(self.buf): return False
+            self._value_done(); return self.feed(ch)
+        if m == "LIT":
+            if not self.buf.startswith(ch): return False
+            self.buf = self.buf[1:]
+            if not self.buf: self._value_done()
+            return True
+        if ch in " \t\n\r":
+            self.ws += 1; return self.ws <= self.MAX_WS
+        self.ws = 0
+        if m == "DONE": return False
+        if m == "VALUE": return self._start_value(ch)
+        if m == "KEY_OR_END":
+            if ch == "}": return self._close_obj()
+            if ch == '"': self.mode = "KEY"; self.buf = ""; return True
+            return False
+        if m == "NEXT_KEY":
+            if ch == '"': self.mode = "KEY"; self.buf = ""; return True
+            return False
+        if m == "COLON":
+            if ch == ":": self.mode = "VALUE"; return True
+            return False
+        if m == "VAL_OR_END":
+            if ch == "]": self.stack = self.stack[:-1]; self._value_done(); return True
+            self.mode = "VALUE"; self.expect = None; return self._start_value(ch)
+        if m == "AFTER":
+            frame = self.stack[-1]
+            if frame[0] == "obj":
+                if ch == "}": return self._close_obj()
+                if ch == "," and not (frame[1] and len(frame[2]) == len(ENVELOPE_KEYS)): self.mode = "NEXT_KEY"; return True
+                return False
+            if ch == "]": self.stack = self.stack[:-1]; self._value_done(); return True
+            if ch == ",": self.mode = "VALUE"; self.expect = None; return True
+            return False
+        return False
+
+_VOCAB_STRINGS: Dict[str, List[str]] = {}
+def vocab_strings(tokX) -> List[str]:
+    """Decoded text of every token id (built once per tokenizer)."""
+    key = getattr(tokX, "name_or_path", "") + f"#{len(tokX)}"
+    if key not in _VOCAB_STRINGS:
+        _VOCAB_STRINGS[key] = [tokX.decode([i], skip_special_tokens=False) for i in range(len(tokX))]
+    return _VOCAB_STRINGS[key]
+
 # --------------- Teacher routing (general vs coder) ---------------
-tok_general = model_general = None
-tok_coder   = model_coder   = None
+def _load_hf(model_id: str):
+    """Tokenizer + eval-mode model; weights come from the local safetensors snapshot (mmap'd by HF)."""
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    torch = __import__('torch')
+    tok = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
+    mdl = AutoModelForCausalLM.from_pretrained(
+        model_id, device_map="auto",
+        torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
+        trust_remote_code=True
+    ); mdl.eval()
+    return tok, mdl
 
 def load_general_teacher():
-    global tok_general, model_general
-    if tok_general is None or model_general is None:
-        from transformers import AutoTokenizer, AutoModelForCausalLM
+    def loader():
         print("Loading general teacher:", CFG.general_teacher)
-        tok_general = AutoTokenizer.from_pretrained(CFG.general_teacher, trust_remote_code=True)
-        model_general = AutoModelForCausalLM.from_pretrained(
-            CFG.general_teacher, device_map="auto",
-            torch_dtype=__import__('torch').bfloat16 if __import__('torch').cuda.is_available() else __import__('torch').float32,
-            trust_remote_code=True
-        ); model_general.eval()
-        print("General teacher device:", model_general.device)
-    return tok_general, model_general
+        tok, mdl = _load_hf(CFG.general_teacher)
+        print("General teacher device:", mdl.device)
+        return tok, mdl, CFG.general_teacher
+    return MODELS.get("general", loader)
 
 def load_coder_teacher():
-    global tok_coder, model_coder
-    from transformers import AutoTokenizer, AutoModelForCausalLM
-    if tok_coder is not None and model_coder is not None: return tok_coder, model_coder
-    try:
-        print("Loading coder teacher:", CFG.coder_teacher)
-        tok_coder = AutoTokenizer.from_pretrained(CFG.coder_teacher, trust_remote_code=True)
-        model_coder = AutoModelForCausalLM.from_pretrained(
-            CFG.coder_teacher, device_map="auto",
-            torch_dtype=__import__('torch').bfloat16 if __import__('torch').cuda.is_available() else __import__('torch').float32,
-            trust_remote_code=True
-        ); model_coder.eval()
-    except Exception as e:
-        print("Coder teacher failed:", str(e)[:200]); print("Trying fallback:", CFG.coder_fallback)
-        tok_coder = AutoTokenizer.from_pretrained(CFG.coder_fallback, trust_remote_code=True)
-        model_coder = AutoModelForCausalLM.from_pretrained(
-            CFG.coder_fallback, device_map="auto",
-            torch_dtype=__import__('torch').bfloat16 if __import__('torch').cuda.is_available() else __import__('torch').float32,
-            trust_remote_code=True
-        ); model_coder.eval()
-    print("Coder teacher device:", model_coder.device)
-    return tok_coder, model_coder
+    def loader():
+        try:
+            print("Loading coder teacher:", CFG.coder_teacher)
+            tok, mdl = _load_hf(CFG.coder_teacher); source = CFG.coder_teacher
+        except Exception as e:
+            print("Coder teacher failed:", str(e)[:200]); print("Trying fallback:", CFG.coder_fallback)
+            tok, mdl = _load_hf(CFG.coder_fallback); source = CFG.coder_fallback
+        print("Coder teacher device:", mdl.device)
+        return tok, mdl, source
+    return MODELS.get("coder", loader)
+
+def unload_teacher(kind: str):
+    """Drop a teacher's weights so the other one can load on a memory-constrained box."""
+    MODELS.unload(kind)
+
+# ------------------------- Model residency manager -------------------------
+class ModelManager:
+    """
+    LRU residency for the teachers and the student under a GPU memory budget.
+    Tiers: gpu → cpu (weights parked in RAM, up to cpu_offload_gb) → unloaded
+    (reload maps the safetensors snapshot from disk). Load/swap times are tracked per model.
+    """
+    def __init__(self):
+        from collections import OrderedDict
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.stats: Dict[str, Dict[str, float]] = {}
+        self.fp_file = LOGSD / "model_footprints.json"
+        self.footprints: Dict[str,int] = json.loads(self.fp_file.read_text()) if self.fp_file.exists() else {}
+
+    def _budget(self, tier: str) -> float:
+        torch = __import__('torch')
+        if tier == "cpu": return CFG.cpu_offload_gb * 1e9
+        if CFG.gpu_budget_gb > 0: return CFG.gpu_budget_gb * 1e9
+        if torch.cuda.is_available():
+            return 0.9 * sum(torch.cuda.get_device_properties(i).total_memory for i in range(torch.cuda.device_count()))
+        return float("inf")
+
+    def _used(self, tier: str, exclude: Optional[str]=None) -> int:
+        return sum(e["bytes"] for n,e in self.entries.items() if e["where"] == tier and n != exclude)
+
+    def _stat(self, name: str, key: str, value: float = 1):
+        s = self.stats.setdefault(name, {"loads": 0, "load_s": 0.0, "swap_ins": 0, "swap_in_s": 0.0,
+                                         "offloads": 0, "offload_s": 0.0, "unloads": 0})
+        s[key] += value
+
+    def _offload(self, name: str):
+        """Park a GPU resident in RAM if it fits and is single-device; otherwise unload it."""
+        e = self.entries[name]; torch = __import__('torch')
+        devices = set((getattr(e["model"], "hf_device_map", None) or {"": 0}).values())
+        if torch.cuda.is_available() and len(devices) <= 1 and self._used("cpu") + e["bytes"] <= self._budget("cpu"):
+            try:
+                t0 = time.time(); e["model"].to("cpu"); e["where"] = "cpu"
+                self._stat(name, "offloads"); self._stat(name, "offload_s", time.time()-t0)
+                print(f"↘ offloaded {name} to CPU ({e['bytes']/1e9:.1f} GB)")
+            except Exception as ex:
+                print(f"Offload of {name} failed ({str(ex)[:120]}) — unloading"); self.unload(name); return
+        else:
+            self.unload(name); return
+        drop_prefix_cache(name)
+        if torch.cuda.is_available(): torch.cuda.empty_cache()
+
+    def _make_room(self, name: str, need: Optional[int]):
+        budget = self._budget("gpu")
+        for other in list(self.entries):
+            if other == name or self.entries[other]["where"] != "gpu": continue
+            if need is not None and self._used("gpu", exclude=name) + need <= budget: break
+            self._offload(other)   # unknown footprint → clear the GPU of everything else
+
+    def get(self, name: str, loader):
+        """(tok, model) for `name`, loading or swapping it in; loader() → (tok, model, source_id)."""
+        e = self.entries.get(name)
+        if e is not None and e["where"] == "gpu":
+            self.entries.move_to_end(name); return e["tok"], e["model"]
+        need = e["bytes"] if e is not None else self.footprints.get(name)
+        self._make_room(name, need)
+        torch = __import__('torch')
+        if e is not None and e["where"] == "cpu":
+            t0 = time.time(); e["model"].to("cuda" if torch.cuda.is_available() else "cpu"); e["where"] = "gpu"
+            self._stat(name, "swap_ins"); self._stat(name, "swap_in_s", time.time()-t0)
+        else:
+            t0 = time.time(); tok, mdl, source = loader()
+            self._stat(name, "loads"); self._stat(name, "load_s", time.time()-t0)
+            e = {"tok": tok, "model": mdl, "source": source, "where": "gpu", "bytes": int(mdl.get_memory_footprint())}
+            self.entries[name] = e
+            self.footprints[name] = e["bytes"]; self.fp_file.write_text(json.dumps(self.footprints, indent=2))
+        self.entries.move_to_end(name)
+        return e["tok"], e["model"]
+
+    def source(self, name: str) -> Optional[str]:
+        """Model id actually loaded for `name` (e.g. the coder fallback), None while not resident."""
+        e = self.entries.get(name); return e["source"] if e else None
+
+    def unload(self, name: str):
+        if self.entries.pop(name, None) is None: return
+        self._stat(name, "unloads"); drop_prefix_cache(name)
+        import gc; gc.collect()
+        torch = __import__('torch')
+        if torch.cuda.is_available(): torch.cuda.empty_cache()
+
+    def unload_all(self):
+        for name in list(self.entries): self.unload(name)
+
+    def report(self) -> str:
+        if not self.stats: return "Models: none loaded."
+        lines = ["Model residency (budget " + (f"{self._budget('gpu')/1e9:.0f} GB" if self._budget('gpu') != float('inf') else "∞") + "):"]
+        for name, s in self.stats.items():
+            e = self.entries.get(name)
+            where = f"{e['where']} {e['bytes']/1e9:.1f} GB" if e else "unloaded"
+            if e: where += f" [{e['source']}]"
+            lines.append(f"  {name:<8} {where:<16} loads {s['loads']} ({s['load_s']:.1f}s) | swap-ins {s['swap_ins']} "
+                         f"({s['swap_in_s']:.1f}s) | offloads {s['offloads']} ({s['offload_s']:.1f}s) | unloads {s['unloads']}")
+        with open(LOGSD / "model_residency.jsonl", "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": int(time.time()), "stats": self.stats,
+                                "sources": {n: e["source"] for n, e in self.entries.items()}}) + "\n")
+        return "\n".join(lines)
+
+MODELS = ModelManager()
 
 CODE_HINTS = ["code","bug","fix","function","class","method","api","endpoint","diff","tests","unit test","pytest","jest","scaffold","refactor","compile","build","ci","lint","coverage","rollback","module","package"]
 def is_code_prompt(p: str) -> bool:
     t=p.lower(); return any(k in t for k in CODE_HINTS)
 
-def ask_teacher(prompt_text: str, eye_hint: Optional[str]=None, max_new: Optional[int]=None) -> Dict[str,Any]:
-    max_new = max_new or CFG.max_new_tokens
+GENERAL_SUFFIX = "\n\nReturn ONLY one valid JSON object."
+CODER_SUFFIX   = "\n\nFor code tasks, keep <think> under ~50 tokens, then output ONE JSON."
+
+def route_teacher(prompt_text: str, eye_hint: Optional[str]=None) -> str:
     use_coder = (eye_hint and eye_hint.upper().startswith("MANGEKYO")) or is_code_prompt(prompt_text)
-    if use_coder:
-        tokX, mdl = load_coder_teacher()
-        persona = FULL_PERSONA + "\n\nFor code tasks, keep <think> under ~50 tokens, then output ONE JSON."
-        teacher_id = CFG.coder_teacher
+    return "coder" if use_coder else "general"
+
+def teacher_profile(kind: str):
+    """(persona, configured teacher_id) for a routed teacher — no model load; MODELS.source() says which model loaded."""
+    if kind == "coder": return FULL_PERSONA + CODER_SUFFIX, CFG.coder_teacher
+    return FULL_PERSONA + GENERAL_SUFFIX, CFG.general_teacher
+
+def load_teacher(kind: str):
+    return load_coder_teacher() if kind == "coder" else load_general_teacher()
+
+def teacher_messages(persona: str, prompt_text: str) -> List[dict]:
+    return [{"role":"system","content": persona},{"role":"user","content": f"PROMPT: {prompt_text}"}]
+
+def teacher_chat(tokX, persona: str, prompt_text: str) -> str:
+    return apply_template(tokX, teacher_messages(persona, prompt_text), add_generation_prompt=True)
+
+# ---- FULL_PERSONA prefix KV cache (prefilled once per teacher × persona variant) ----
+class PrefixKV:
+    def __init__(self, ids: List[int], cache, model_ref: int):
+        self.ids, self.cache, self.model_ref = ids, cache, model_ref
+    def expand(self, n: int):
+        """Private copy of the prefix cache repeated for a batch of n rows."""
+        import copy
+        c = copy.deepcopy(self.cache)
+        if n > 1: c.batch_repeat_interleave(n)
+        return c
+
+_PREFIX_KV: Dict[tuple, PrefixKV] = {}
+
+def persona_prefix(kind: str, tokX, mdl, persona: str) -> Optional[PrefixKV]:
+    """Prefill the token prefix every prompt shares (system persona + 'PROMPT:') and keep its KV cache."""
+    if not CFG.prefix_cache: return None
+    key = (kind, TeacherCache.persona_sha(persona))
+    hit = _PREFIX_KV.get(key)
+    if hit is not None and hit.model_ref == id(mdl): return hit
+    a = tokX(teacher_chat(tokX, persona, "a")).input_ids
+    b = tokX(teacher_chat(tokX, persona, "b")).input_ids
+    n = 0
+    while n < min(len(a), len(b)) and a[n] == b[n]: n += 1
+    ids = a[:n-1]   # back off one token so a BPE merge at the boundary can't straddle it
+    if len(ids) < 2: return None
+    torch = __import__('torch')
+    with torch.inference_mode():
+        out = mdl(input_ids=torch.tensor([ids], device=mdl.device), use_cache=True)
+    _PREFIX_KV[key] = PrefixKV(ids, out.past_key_values, id(mdl))
+    return _PREFIX_KV[key]
+
+def drop_prefix_cache(kind: Optional[str]=None):
+    for k in [k for k in _PREFIX_KV if kind is None or k[0] == kind]: del _PREFIX_KV[k]
+
+class GenTrace:
+    """Per-row EnvelopeScan over generated tokens, shared by the stop criterion and the think budget."""
+    def __init__(self, tokX, n_in: int, modes: List[str]):
+        self.tokX, self.n_in = tokX, n_in
+        self.rows = [EnvelopeScan(mode=m) for m in modes]
+        self.think_tokens = [0]*len(modes)
+    def feed_row(self, r: int, new: List[int]):
+        sc = self.rows[r]
+        if sc.closed or not new: return
+        in_think = sc.mode == "think"
+        sc.n_tok += len(new)
+        sc.feed(self.tokX.decode(new, skip_special_tokens=False))
+        if in_think: self.think_tokens[r] += len(new)
+    def sync(self, input_ids):
+        for r, sc in enumerate(self.rows):
+            if not sc.closed: self.feed_row(r, input_ids[r, self.n_in + sc.n_tok:].tolist())
+
+class EnvelopeStop:
+    """StoppingCriteria: each row stops once its first top-level JSON object after </think> closes."""
+    def __init__(self, trace: GenTrace): self.trace = trace
+    def __call__(self, input_ids, scores, **kwargs):
+        torch = __import__('torch')
+        self.trace.sync(input_ids)
+        return torch.tensor([sc.closed for sc in self.trace.rows], dtype=torch.bool, device=input_ids.device)
+
+class ThinkBudget:
+    """LogitsProcessor: once a row has spent its budget inside <think>, force the </think> tokens."""
+    def __init__(self, trace: GenTrace, budgets: List[int]):
+        self.trace, self.budgets = trace, budgets
+        self.close_ids = trace.tokX("</think>", add_special_tokens=False).input_ids
+        self.forced = [0]*len(budgets)
+    def __call__(self, input_ids, scores):
+        self.trace.sync(input_ids)
+        for r, sc in enumerate(self.trace.rows):
+            b = self.budgets[r]
+            if b <= 0 or sc.mode != "think" or self.trace.think_tokens[r] < b: continue
+            if self.forced[r] >= len(self.close_ids): continue
+            tid = self.close_ids[self.forced[r]]; self.forced[r] += 1
+            keep = scores[r, tid].clone()
+            scores[r, :] = -float("inf"); scores[r, tid] = keep if keep.isfinite() else 0.0
+        return scores
+
+class JsonConstraint:
+    """
+    LogitsProcessor: outside <think>, keep only tokens whose text extends a valid envelope
+    (JsonGuide). Checks the top-k candidates first and widens to the full vocab only when
+    none of them fit; EOS is allowed once the envelope is complete.
+    """
+    def __init__(self, trace: GenTrace, topk: int = 32):
+        self.trace, self.topk = trace, topk
+        self.vocab = vocab_strings(trace.tokX)
+        self.eos = trace.tokX.eos_token_id
+        self.guides: List[Optional[JsonGuide]] = [None]*len(trace.rows)
+        self.fed = [0]*len(trace.rows)
+
+    def _guide(self, r: int) -> JsonGuide:
+        sc = self.trace.rows[r]
+        if self.guides[r] is None: self.guides[r] = JsonGuide(); self.fed[r] = sc.json_from
+        g = self.guides[r]
+        for ch in sc.buf[self.fed[r]:]:
+            if not g.feed(ch): break
+        self.fed[r] = len(sc.buf)
+        return g
+
+    def _allowed(self, r: int, g: Optional[JsonGuide], tid: int) -> bool:
+        if tid == self.eos: return g is not None and g.done
+        piece = self.vocab[tid] if tid < len(self.vocab) else ""
+        if not piece: return False
+        if g is None:   # still undecided between "<think>" and a bare envelope
+            head = (self.trace.rows[r].buf + piece).lstrip(" \t\n\r")
+            if "<think>".startswith(head) or head.startswith("<think>"): return True
+            if self.trace.rows[r].buf.strip(" \t\n\r"): return False
+            g = JsonGuide()
+        else:
+            g = g.copy()
+        return all(g.feed(ch) for ch in piece)
+
+    def __call__(self, input_ids, scores):
+        self.trace.sync(input_ids)
+        for r, sc in enumerate(self.trace.rows):
+            if sc.mode == "think": continue
+            g = self._guide(r) if sc.mode == "json" else None
+            row = scores[r]
+            k = min(self.topk, row.shape[-1])
+            ok = [t for t in row.topk(k).indices.tolist() if self._allowed(r, g, t)]
+            if not ok:
+                for t in row.argsort(descending=True).tolist():
+                    if self._allowed(r, g, t): ok = [t]; break
+            if ok:
+                keep = row[ok].clone()
+                row[:] = -float("inf"); row[ok] = keep
+        return scores
+
+def think_budget_for(kind: str, eye_hint: Optional[str]=None) -> int:
+    """Per-eye <think> token budget; code-routed prompts count as MANGEKYO. 0 = unlimited."""
+    eye = (eye_hint or ("MANGEKYO" if kind == "coder" else "")).upper()
+    return int(CFG.think_budget.get(eye, CFG.think_budget.get("DEFAULT", 0)) or 0)
+
+def _think_mode(chat: str) -> str:
+    """Scanner start mode: "think" when the generation prompt already opened <think>."""
+    return "think" if chat.rfind("<think>") > chat.rfind("</think>") else "pre"
+
+class GreedyRows:
+    """LogitsProcessor: leave only the argmax on the given rows, so they decode greedily inside a sampled batch."""
+    def __init__(self, rows: List[int]): self.rows = rows
+    def __call__(self, input_ids, scores):
+        for r in self.rows:
+            t = int(scores[r].argmax()); keep = scores[r, t].clone()
+            scores[r, :] = -float("inf"); scores[r, t] = keep
+        return scores
+
+def _generate_rows(tokX, mdl, chats: List[str], max_new: int, prefix: Optional[PrefixKV]=None, think_budget: int = 0,
+                   n_return: int = 1, seed: int = 0):
+    """
+    Greedy-decode a batch; returns (per-row completions, amortized seconds per row, per-row meta).
+    Without a prefix rows are left-padded; with one they are laid out as
+    prefix | pad | suffix so the shared prefix KV applies to every row (positions come
+    from the attention mask, so the padding gap is invisible to the model).
+    With n_return > 1 every chat is prefilled once, its KV repeated n_return times, and the
+    copies decoded together: the first copy greedily, the rest sampled (aug_temperature /
+    aug_top_p). Outputs are chat-major (chat 0 copies, chat 1 copies, ...).
+    """
+    torch = __import__('torch')
+    if tokX.pad_token is None: tokX.pad_token = tokX.eos_token
+    pad = tokX.pad_token_id
+    ids = [tokX(c).input_ids for c in chats]
+    kw = {}
+    if prefix is not None and all(r[:len(prefix.ids)] == prefix.ids for r in ids):
+        P = len(prefix.ids); L = max(len(r) for r in ids) - P
+        rows = [prefix.ids + [pad]*(L-len(r)+P) + r[P:] for r in ids]
+        mask = [[1]*P + [0]*(L-len(r)+P) + [1]*(len(r)-P) for r in ids]
+        kw["past_key_values"] = prefix.expand(len(ids))
+    else:
+        P = 0; L = max(len(r) for r in ids)
+        rows = [[pad]*(L-len(r)) + r for r in ids]
+        mask = [[0]*(L-len(r)) + [1]*len(r) for r in ids]
+    input_ids = torch.tensor(rows, device=mdl.device)
+    attention_mask = torch.tensor(mask, device=mdl.device)
+    n_in = input_ids.shape[1]
+    t0=time.time(); prefill_s = 0.0
+    if n_return > 1:
+        # Prefill all but the last token once per chat, then fan the KV out to n_return rows;
+        # generate() only has to run the uncached last token.
+        pos = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        with torch.inference_mode():
+            out = mdl(input_ids=input_ids[:, P:n_in-1], attention_mask=attention_mask[:, :n_in-1],
+                      position_ids=pos[:, P:n_in-1], past_key_values=kw.get("past_key_values"), use_cache=True)
+        cache = out.past_key_values; cache.batch_repeat_interleave(n_return)
+        kw["past_key_values"] = cache
+        input_ids = input_ids.repeat_interleave(n_return, dim=0)
+        attention_mask = attention_mask.repeat_interleave(n_return, dim=0)
+        chats = [c for c in chats for _ in range(n_return)]
+        prefill_s = time.time() - t0
+        torch.manual_seed(seed)
+        kw.update(do_sample=True, temperature=CFG.aug_temperature, top_p=CFG.aug_top_p)
     else:
-        tokX, mdl = load_general_teacher()
-        persona = FULL_PERSONA + "\n\nReturn ONLY one valid JSON object."
-        teacher_id = CFG.general_teacher
-    messages = [{"role":"system","content": persona},{"role":"user","content": f"PROMPT: {prompt_text}"}]
-    chat = apply_template(tokX, messages, add_generation_prompt=True)
-    inputs = tokX(chat, return_tensors="pt").to(mdl.device)
-    t0=time.time()
-    with __import__('torch').inference_mode():
-        out = mdl.generate(**inputs, max_new_tokens=max_new, do_sample=False, temperature=0.0,
-                           pad_token_id=tokX.eos_token_id, eos_token_id=tokX.eos_token_id)
-    raw = tokX.decode(out[0], skip_special_tokens=False)
-    elapsed = round(time.time()-t0, 2)
+        kw.update(do_sample=False, temperature=0.0)
+    trace = GenTrace(tokX, n_in, [_think_mode(c) for c in chats])
+    if CFG.stop_on_envelope:
+        from transformers import StoppingCriteriaList
+        kw["stopping_criteria"] = StoppingCriteriaList([EnvelopeStop(trace)])
+    procs = []
+    if think_budget > 0: procs.append(ThinkBudget(trace, [think_budget]*len(chats)))
+    if CFG.constrained_json: procs.append(JsonConstraint(trace, CFG.json_topk))
+    if n_return > 1: procs.append(GreedyRows(list(range(0, len(chats), n_return))))
+    if procs:
+        from transformers import LogitsProcessorList
+        kw["logits_processor"] = LogitsProcessorList(procs)
+    with torch.inference_mode():
+        out = mdl.generate(input_ids=input_ids, attention_mask=attention_mask, max_new_tokens=max_new,
+                           pad_token_id=pad, eos_token_id=tokX.eos_token_id, **kw)
+    per_row = round((time.time()-t0)/len(chats), 2)
+    raws, metas = [], []
+    for r, row in enumerate(out[:, n_in:].tolist()):
+        while row and row[-1] == pad: row.pop()
+        raws.append(tokX.decode(row, skip_special_tokens=False))
+        trace.feed_row(r, row[trace.rows[r].n_tok:])
+        closed = CFG.stop_on_envelope and trace.rows[r].closed
+        metas.append({"gen_tokens": len(row), "tokens_saved": max(0, max_new - len(row)) if closed else 0,
+                      "think_budget": think_budget, "think_tokens": trace.think_tokens[r]})
+        if n_return > 1:   # the (n_return-1) prefills a per-variation call would have repeated
+            metas[-1]["prefill_saved_s"] = round(prefill_s / len(ids) * (n_return-1), 3) if r % n_return == 0 else 0.0
+    return raws, per_row, metas
+
+# ---- OpenAI-compatible HTTP teacher backend (vLLM & co.) ----
+ENVELOPE_SCHEMA = {
+    "type": "object", "additionalProperties": False, "required": list(ENVELOPE_KEYS),
+    "properties": {k: {"type": {"string": "string", "bool": "boolean", "object": "object"}[t]}
+                   for k,t in ENVELOPE_KEYS.items()},
+}
+
+def _run_async(coro):
+    """asyncio.run that also works when a loop is already running (notebooks)."""
+    import asyncio
+    try: asyncio.get_running_loop()
+    except RuntimeError: return asyncio.run(coro)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(1) as ex: return ex.submit(asyncio.run, coro).result()
+
+async def _http_chat_all(model: str, conversations: List[List[dict]], max_new: int, n: int = 0):
+    import asyncio, random, httpx
+    key = os.getenv(CFG.teacher_api_key_env, "")
+    headers = {"Authorization": f"Bearer {key}"} if key else {}
+    limits = httpx.Limits(max_connections=CFG.http_max_inflight, max_keepalive_connections=CFG.http_max_inflight)
+    sem = asyncio.Semaphore(CFG.http_max_inflight)
+    retry_status = {408, 409, 429, 500, 502, 503, 504}
+    async with httpx.AsyncClient(base_url=CFG.teacher_base_url.rstrip("/"), headers=headers,
+                                 timeout=CFG.http_timeout_s, limits=limits) as client:
+        async def one(messages):
+            body = {"model": model, "messages": messages, "max_tokens": max_new, "temperature": 0.0}
+            if n: body.update(n=n, temperature=CFG.aug_temperature, top_p=CFG.aug_top_p)
+            if CFG.constrained_json:
+                body["response_format"] = {"type": "json_schema", "json_schema": {"name": "envelope", "schema": ENVELOPE_SCHEMA}}
+            async with sem:
+                for attempt in range(CFG.http_retries + 1):
+                    t0 = time.time()
+                    try:
+                        r = await client.post("/chat/completions", json=body)
+                        if r.status_code in retry_status: raise httpx.HTTPStatusError(f"HTTP {r.status_code}", request=r.request, response=r)
+                        r.raise_for_status()
+                        js = r.json(); outs = []
+                        for ch in sorted(js["choices"], key=lambda c: c.get("index", 0)):
+                            msg = ch["message"]; raw = msg.get("content") or ""
+                            think = msg.get("reasoning_content") or msg.get("reasoning")
+                            if think: raw = f"<think>{think}</think>\n{raw}"
+                            outs.append(raw)
+                        toks = (js.get("usage") or {}).get("completion_tokens")
+                        toks = toks // len(outs) if toks else toks
+                        el = round((time.time()-t0) / len(outs), 2)
+                        return [(raw, el, {"gen_tokens": toks, "tokens_saved": 0, "think_budget": 0, "think_tokens": None})
+                                for raw in outs]
+                    except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                        status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+                        if attempt == CFG.http_retries or (status is not None and status not in retry_status): raise
+                        await asyncio.sleep(CFG.http_backoff_s * 2**attempt * (0.5 + random.random()))
+        return await asyncio.gather(*(one(m) for m in conversations), return_exceptions=True)
+
+def http_generate(model: str, conversations: List[List[dict]], max_new: int, n: int = 0):
+    """
+    [(raw, elapsed_s, meta)] in input order; failed requests come back as empty completions.
+    With n > 0 each entry is a list of n sampled completions from one request (server-side shared prefill).
+    """
+    outs = _run_async(_http_chat_all(model, conversations, max_new, n))
+    res = []
+    for o in outs:
+        if isinstance(o, BaseException):
+            print("⚠ teacher request failed:", str(o)[:200])
+            o = [("", 0.0, {"gen_tokens": 0, "tokens_saved": 0, "think_budget": 0, "think_tokens": None})] * max(1, n)
+        o = list(o) + [o[-1]] * (n - len(o)) if n else o[0]   # short replies: pad with the last choice
+        res.append(o)
+    return res
+
+def teacher_decode_params(think_budget: int = 0, n_aug: int = 0, row: int = 0) -> Dict[str,Any]:
+    """Everything besides persona/prompt/max_new that changes a teacher completion (cache key)."""
+    p = {"do_sample": False, "temperature": 0.0, "stop_on_envelope": CFG.stop_on_envelope,
+         "think_budget": think_budget, "constrained_json": CFG.constrained_json, "backend": CFG.teacher_backend}
+    if row > 0:   # sampled variation `row` of n_aug from a shared prefill
+        p.update(do_sample=True, temperature=CFG.aug_temperature, top_p=CFG.aug_top_p, n_aug=n_aug, row=row)
+    return p
+
+def _teacher_result(raw: str, teacher_id: str, elapsed_s: float, **extra) -> Dict[str,Any]:
     res = extract_reasoning_and_json(raw)
-    res.update({"raw": raw, "teacher_id": teacher_id, "elapsed_s": elapsed})
+    res.update({"raw": raw, "teacher_id": teacher_id, "elapsed_s": elapsed_s}, **extra)
     return res
 
+def ask_teacher_batch(prompts: List[str], eye_hint: Optional[str]=None, max_new: Optional[int]=None,
+                      n_aug: int = 0) -> List[Dict[str,Any]]:
+    """
+    Batched ask_teacher: route each prompt, serve what the response cache already holds,
+    then per teacher sort the misses by token length and generate in padded batches of
+    CFG.label_batch_size. Results come back in input order.
+    With n_aug > 0 each result also carries "samples": n_aug sampled variations decoded
+    from the same prefill as the (greedy) base completion.
+    """
+    max_new = max_new or CFG.max_new_tokens
+    results: List[Optional[Dict[str,Any]]] = [None]*len(prompts)
+    groups: Dict[str,List[int]] = {}
+    for i,p in enumerate(prompts): groups.setdefault(route_teacher(p, eye_hint), []).append(i)
+    bs = max(1, CFG.label_batch_size // (1 + n_aug))
+    cache = teacher_cache() if CFG.teacher_cache else None
+    for kind, idxs in groups.items():
+        persona, teacher_id = teacher_profile(kind)
+        ids = [teacher_id]
+        if CFG.teacher_backend == "hf" and kind == "coder":
+            # the fallback may stand in for the coder: entries and rows carry the model that generated them,
+            # so until one is resident, hits come from whichever of the two holds the row
+            src = MODELS.source(kind)
+            ids = [src] if src else list(dict.fromkeys([CFG.coder_teacher, CFG.coder_fallback]))
+        budget = think_budget_for(kind, eye_hint) if CFG.teacher_backend == "hf" else 0
+        def keys(i: int, tid: str) -> List[str]:
+            return [cache.key(tid, persona, prompts[i], max_new, teacher_decode_params(budget, n_aug, k))
+                    for k in range(1 + n_aug)]
+        if cache is not None:
+            for i in idxs:
+                tid = ids[0] if len(ids) == 1 else next((t for t in ids if cache.holds(keys(i, t))), ids[0])
+                hits = [cache.get(key, tid) for key in keys(i, tid)]
+                if all(hits):
+                    res = []
+                    for hit in hits:
+                        meta = dict(hit["meta"]); elapsed = meta.pop("elapsed_s", 0.0)
+                        res.append(_teacher_result(hit["raw"], tid, elapsed, cache_hit=True, **meta))
+                    results[i] = res[0]
+                    if n_aug: results[i]["samples"] = res[1:]
+            idxs = [i for i in idxs if results[i] is None]
+            if not idxs: continue   # fully cached → never load this teacher
+
+        def store(i: int, outs: List[tuple]):
+            res = [_teacher_result(raw, teacher_id, elapsed, cache_hit=False, **meta) for raw, elapsed, meta in outs]
+            results[i] = res[0]
+            if n_aug: results[i]["samples"] = res[1:]
+            if cache is not None:
+                for key, (raw, elapsed, meta) in zip(keys(i, teacher_id), outs):
+                    if raw: cache.put(key, teacher_id, persona, raw, {"elapsed_s": elapsed, **meta})
+
+        if CFG.teacher_backend == "openai":
+            convs = [teacher_messages(persona, prompts[i]) for i in idxs]
+            base = http_generate(teacher_id, convs, max_new)
+            samples = http_generate(teacher_id, convs, max_new, n=n_aug) if n_aug else [[]]*len(idxs)
+            for i, b, smp in zip(idxs, base, samples): store(i, [b] + list(smp))
+            continue
+        tokX, mdl = load_teacher(kind); teacher_id = MODELS.source(kind)
+        prefix = persona_prefix(kind, tokX, mdl, persona)
+        chats = {i: teacher_chat(tokX, persona, prompts[i]) for i in idxs}
+        n_tok = {i: len(tokX(chats[i]).input_ids) for i in idxs}
+        order = sorted(idxs, key=lambda i: n_tok[i])   # length buckets → little padding per batch
+        for b in range(0, len(order), bs):
+            chunk = order[b:b+bs]
+            seed = zlib.crc32("\n".join(prompts[i] for i in chunk).encode("utf-8"))   # reproducible sampling
+            raws, per_row, metas = _generate_rows(tokX, mdl, [chats[i] for i in chunk], max_new, prefix, budget,
+                                                  n_return=1 + n_aug, seed=seed)
+            for j, i in enumerate(chunk):
+                rows = range(j * (1 + n_aug), (j + 1) * (1 + n_aug))
+                store(i, [(raws[r], per_row, metas[r]) for r in rows])
+    return results
+
+def ask_teacher(prompt_text: str, eye_hint: Optional[str]=None, max_new: Optional[int]=None) -> Dict[str,Any]:
+    return ask_teacher_batch([prompt_text], eye_hint, max_new)[0]
+
+# ------------------------- Teacher response cache -------------------------
+class TeacherCache:
+    """
+    Content-addressed SQLite cache of raw teacher completions.
+    Key = sha256(teacher_id, persona sha, prompt, max_new, decode params); LRU-evicted past max_mb.
+    """
+    def __init__(self, path: Path, max_mb: int):
+        import sqlite3
+        self.db = sqlite3.connect(str(path), check_same_thread=False, timeout=60)   # shared by label shards
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS teacher_cache(
+            key TEXT PRIMARY KEY, teacher_id TEXT, persona_sha TEXT, raw TEXT, meta TEXT,
+            nbytes INTEGER, created REAL, last_used REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS teacher_cache_lru ON teacher_cache(last_used)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS teacher_cache_tid ON teacher_cache(teacher_id)")
+        self.db.commit()
+        self.max_bytes = int(max_mb) * 1024 * 1024
+        self.total = self.db.execute("SELECT COALESCE(SUM(nbytes),0) FROM teacher_cache").fetchone()[0]
+        self.hits: Dict[str,int] = {}; self.misses: Dict[str,int] = {}
+
+    @staticmethod
+    def persona_sha(persona: str) -> str:
+        import hashlib
+        return hashlib.sha256(persona.encode("utf-8")).hexdigest()
+
+    def key(self, teacher_id: str, persona: str, prompt_text: str, max_new: int, params: Dict[str,Any]) -> str:
+        import hashlib
+        blob = json.dumps([teacher_id, self.persona_sha(persona), prompt_text, int(max_new), params],
+                          ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, teacher_id: str) -> Optional[dict]:
+        row = self.db.execute("SELECT raw, meta FROM teacher_cache WHERE key=?", (key,)).fetchone()
+        if row is None:
+            self.misses[teacher_id] = self.misses.get(teacher_id,0)+1; return None
+        self.hits[teacher_id] = self.hits.get(teacher_id,0)+1
+        self.db.execute("UPDATE teacher_cache SET last_used=? WHERE key=?", (time.time(), key)); self.db.commit()
+        return {"raw": row[0], "meta": json.loads(row[1] or "{}")}
+
+    def holds(self, keys: List[str]) -> bool:
+        """All of `keys` cached? (no hit/miss accounting, no LRU touch)"""
+        q = f"SELECT COUNT(*) FROM teacher_cache WHERE key IN ({','.join('?' * len(keys))})"
+        return self.db.execute(q, keys).fetchone()[0] == len(set(keys))
+
+    def put(self, key: str, teacher_id: str, persona: str, raw: str, meta: Dict[str,Any]):
+        meta_s = json.dumps(meta, ensure_ascii=False)
+        nbytes = len(raw.encode("utf-8")) + len(meta_s)
+        old = self.db.execute("SELECT nbytes FROM teacher_cache WHERE key=?", (key,)).fetchone()
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO teacher_cache VALUES (?,?,?,?,?,?,?,?)",
+                        (key, teacher_id, self.persona_sha(persona), raw, meta_s, nbytes, now, now))
+        self.total += nbytes - (old[0] if old else 0)
+        if self.total > self.max_bytes: self.evict()
+        self.db.commit()
+
+    def evict(self, target_frac: float = 0.9):
+        """Drop least-recently-used entries until the cache is under target_frac of the cap."""
+        target = int(self.max_bytes * target_frac); dropped = 0
+        while self.total > target:
+            rows = self.db.execute("SELECT key, nbytes FROM teacher_cache ORDER BY last_used LIMIT 256").fetchall()
+            if not rows: self.total = 0; break
+            self.db.executemany("DELETE FROM teacher_cache WHERE key=?", [(k,) for k,_ in rows])
+            self.total -= sum(n for _,n in rows); dropped += len(rows)
+        self.db.commit()
+        return dropped
+
+    def invalidate(self, teacher_id: Optional[str]=None, stale_persona_of: Optional[Dict[str,str]]=None) -> int:
+        """Delete one teacher's entries, or (stale_persona_of={teacher_id: persona}) those made with an old persona."""
+        if stale_persona_of:
+            n = 0
+            for tid, persona in stale_persona_of.items():
+                n += self.db.execute("DELETE FROM teacher_cache WHERE teacher_id=? AND persona_sha!=?",
+                                     (tid, self.persona_sha(persona))).rowcount
+        else:
+            n = self.db.execute("DELETE FROM teacher_cache WHERE teacher_id=?", (teacher_id,)).rowcount
+        self.db.commit()
+        self.total = self.db.execute("SELECT COALESCE(SUM(nbytes),0) FROM teacher_cache").fetchone()[0]
+        return n
+
+    def stats(self) -> List[tuple]:
+        return self.db.execute("SELECT teacher_id, COUNT(*), SUM(nbytes) FROM teacher_cache GROUP BY teacher_id").fetchall()
+
+    def report(self) -> str:
+        tids = sorted(set(self.hits) | set(self.misses))
+        if not tids: return "Teacher cache: no lookups."
+        parts = [f"{t}: {self.hits.get(t,0)} hit / {self.misses.get(t,0)} miss" for t in tids]
+        return f"Teacher cache ({self.total/1e6:.1f} MB): " + " | ".join(parts)
+
+_TEACHER_CACHE: Optional[TeacherCache] = None
+def teacher_cache() -> TeacherCache:
+    global _TEACHER_CACHE
+    if _TEACHER_CACHE is None: _TEACHER_CACHE = TeacherCache(CFG.teacher_cache_db, CFG.teacher_cache_mb)
+    return _TEACHER_CACHE
+
 # ------------------------- Distillation labels & invariants -------------------------
 AR_RE = re.compile(r"[\u0600-\u06FF]")
 def detect_lang(s: str) -> str: return "ar" if AR_RE.search(s) else "en"
@@ -344,6 +1557,10 @@ def make_labeled_record(prompt: str, teacher_res: dict) -> Optional[dict]:
         "teacher_id": teacher_res["teacher_id"],
         "teacher_type": "coder" if ("Coder" in teacher_res["teacher_id"] or "DeepSeek" in teacher_res["teacher_id"]) else "general",
         "elapsed_s": teacher_res["elapsed_s"],
+        "gen_tokens": teacher_res.get("gen_tokens"),
+        "tokens_saved": teacher_res.get("tokens_saved", 0),
+        "think_budget": teacher_res.get("think_budget", 0),
+        "think_tokens": teacher_res.get("think_tokens"),
         "lang": detect_lang(prompt),
         "reasoning_md": teacher_res["reasoning"],
         "envelope": env,
@@ -357,6 +1574,99 @@ def make_labeled_record(prompt: str, teacher_res: dict) -> Optional[dict]:
     apply_invariants(rec)
     return rec
 
+# ------------------------- Columnar dataset store -------------------------
+# The JSONL stays the append log (group commit, recovery, shards, export); readers go through the Parquet
+# copy, hive-partitioned by eye_tag/lang. Nested envelopes are stored as JSON text, invariant_checks as a map,
+# and "offset" is the row's byte offset in the JSONL (file order, and the link back to the exact line).
+def tail_digest(path: Path, offset: int) -> str:
+    """Fingerprint of the 4 KB before `offset`: tells an append (unchanged) from a rewind or rewrite behind a reader."""
+    import hashlib
+    with open(path, "rb") as f:
+        f.seek(max(0, offset - 4096)); return hashlib.blake2b(f.read(offset - max(0, offset - 4096)), digest_size=16).hexdigest()
+
+def dataset_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("offset", pa.int64()), ("prompt", pa.string()), ("variation", pa.int64()), ("teacher_id", pa.string()),
+        ("teacher_type", pa.string()), ("elapsed_s", pa.float64()), ("gen_tokens", pa.int64()),
+        ("tokens_saved", pa.int64()), ("think_budget", pa.int64()), ("think_tokens", pa.int64()),
+        ("reasoning_md", pa.string()), ("reasoning_chars", pa.int64()), ("envelope", pa.string()),
+        ("json_valid", pa.bool_()), ("is_code", pa.bool_()), ("split", pa.string()), ("weight", pa.float64()),
+        ("ts", pa.int64()), ("invariant_checks", pa.map_(pa.string(), pa.bool_())),
+        ("eye_tag", pa.string()), ("lang", pa.string()),
+    ])
+
+def dataset_partitioning():
+    import pyarrow as pa, pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([("eye_tag", pa.string()), ("lang", pa.string())]), flavor="hive")
+
+def store_row(offset: int, r: dict) -> dict:
+    import orjson
+    row = {k: r.get(k) for k in ("prompt", "variation", "teacher_id", "teacher_type", "elapsed_s", "gen_tokens",
+                                 "tokens_saved", "think_budget", "think_tokens", "reasoning_md", "json_valid",
+                                 "is_code", "split", "weight", "ts", "eye_tag", "lang")}
+    row.update(offset=offset, reasoning_chars=len(r.get("reasoning_md") or ""),
+               envelope=orjson.dumps(r.get("envelope")).decode("utf-8"),
+               invariant_checks=list((r.get("invariant_checks") or {}).items()))
+    return row
+
+def sync_dataset_store(batch: int = 50_000) -> Dict[str,int]:
+    """
+    Bring CFG.dataset_store up to the JSONL: complete lines past the last synced offset become one part file
+    per partition every `batch` rows. A replaced (merge) or rewound (recovery) JSONL is re-synced from 0.
+    """
+    import pyarrow as pa, pyarrow.dataset as ds, orjson, shutil
+    path, store = CFG.dataset_jsonl, CFG.dataset_store
+    state_p = store / "_sync.json"
+    try: state = json.loads(state_p.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError): state = {}
+    fst = path.stat(); off = state.get("offset", 0)
+    if ([state.get("dev"), state.get("ino")] != [fst.st_dev, fst.st_ino] or off > fst.st_size
+            or tail_digest(path, off) != state.get("tail")):
+        shutil.rmtree(store, ignore_errors=True); state, off = {"rows": 0, "bad": 0}, 0
+    store.mkdir(parents=True, exist_ok=True)
+    schema, part, new = dataset_schema(), dataset_partitioning(), 0
+    def flush(rows: list, start: int, end: int):
+        nonlocal new
+        if rows:
+            ds.write_dataset(pa.Table.from_pylist(rows, schema=schema), store, format="parquet", partitioning=part,
+                             basename_template=f"part-{start:014d}-{{i}}.parquet", existing_data_behavior="overwrite_or_ignore")
+        state.update(offset=end, dev=fst.st_dev, ino=fst.st_ino, tail=tail_digest(path, end), rows=state["rows"] + len(rows))
+        tmp = state_p.with_suffix(".tmp"); tmp.write_text(json.dumps(state), encoding="utf-8"); os.replace(tmp, state_p)
+        new += len(rows)
+    with open(path, "rb") as f:
+        f.seek(off); rows, start, pos = [], off, off
+        for line in f:
+            if not line.endswith(b"\n"): break   # a row still being written
+            try: rows.append(store_row(pos, orjson.loads(line)))
+            except orjson.JSONDecodeError: state["bad"] += 1
+            pos += len(line)
+            if len(rows) >= batch: flush(rows, start, pos); rows, start = [], pos
+        if pos != state.get("offset"): flush(rows, start, pos)
+    return {"rows": state["rows"], "new": new, "bad": state["bad"]}
+
+def read_dataset(columns: Optional[List[str]] = None, filters=None):
+    """
+    The distillation dataset as a pyarrow Table: synced from the JSONL first, then read memory-mapped with only
+    `columns` (and `filters`, e.g. [("eye_tag", "=", "TENSEIGAN")], pruning partitions). Rows are in file order
+    when "offset" is among the columns.
+    """
+    import pyarrow.parquet as pq
+    sync_dataset_store()
+    if not any(CFG.dataset_store.glob("*/*/*.parquet")): return dataset_schema().empty_table().select(columns or dataset_schema().names)
+    t = pq.read_table(CFG.dataset_store, columns=columns, filters=filters, memory_map=True, partitioning=dataset_partitioning())
+    return t.sort_by("offset") if "offset" in t.column_names else t
+
+def action_query_dataset():
+    import orjson
+    if not CFG.dataset_jsonl.exists(): print("Dataset not found:", CFG.dataset_jsonl); return
+    spec = input("Filter (e.g. eye_tag=TENSEIGAN lang=ar teacher_id=… json_valid=true flag=…): ").strip()
+    t0 = time.time(); rows = query_dataset(**parse_filter(spec))
+    out = OUTD / "query.jsonl"
+    with open(out, "wb") as f:
+        for r in rows: f.write(orjson.dumps(r) + b"\n")
+    print(f"✅ {len(rows)} rows in {time.time()-t0:.2f}s → {out}")
+
 # ------------------------- Student dataset -------------------------
 def build_sft_messages(rec: dict, eye_tagging: bool=True) -> List[dict]:
     think = (rec.get("reasoning_md","") or "").strip()
@@ -370,14 +1680,267 @@ def build_sft_messages(rec: dict, eye_tagging: bool=True) -> List[dict]:
         {"role":"assistant","content": assistant}
     ]
 
+def messages_to_text(tok, messages: List[dict]) -> str:
+    if hasattr(tok,"apply_chat_template"):
+        return tok.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+    return "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+
+# ------------------------- SFT token cache -------------------------
+# Tokenized SFT rows live in Arrow IPC files under sft_cache_dir/<cache key>/, read memory-mapped.
+# The cache key covers the tokenizer, the rendered template, use_eye_tag and max_seq_len; rows inside
+# are keyed by a hash of the fields build_sft_messages reads, so a rerun tokenizes only new rows.
+SFT_ENVELOPE_KEYS = ["tag","ok","code","md","data","next"]
+SFT_PROBE = {"prompt": "probe", "reasoning_md": "probe", "eye_tag": "jogan",
+             "envelope": {"tag": "JOGAN", "ok": True, "code": "OK", "md": "", "data": {}, "next": []}}
+
+def sft_cache_key(tok) -> str:
+    """Tokenizer (vocab/merges/normalizer/specials), chat template as rendered on a probe record, use_eye_tag, max_seq_len."""
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    be = getattr(tok, "backend_tokenizer", None)
+    if be is not None:
+        spec = json.loads(be.to_str()); spec.pop("truncation", None); spec.pop("padding", None)   # per-call state
+    else:
+        spec = sorted(tok.get_vocab().items())
+    h.update(json.dumps(spec, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    h.update(json.dumps([type(tok).__name__, tok.pad_token_id, messages_to_text(tok, build_sft_messages(SFT_PROBE)),
+                         CFG.use_eye_tag, CFG.max_seq_len], ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+def sft_row_key(prompt: str, reasoning_md: str, eye_tag: str, envelope_json: str) -> bytes:
+    import hashlib, orjson
+    return hashlib.blake2b(orjson.dumps([prompt, reasoning_md, eye_tag, envelope_json]), digest_size=16).digest()
+
+def sft_tokenize(tok, rows: List[tuple]):
+    """
+    Tokenize (prompt, reasoning_md, eye_tag, envelope JSON) rows as SFTTrainer did (chat template, special tokens,
+    truncation at max_seq_len). Labels are the ids with pad-token ids masked (-100), as the LM collator did;
+    rows whose envelope lacks a required key get no tokens.
+    """
+    import orjson
+    texts, ok = [], []
+    for prompt, rm, tag, env_json in rows:
+        env = orjson.loads(env_json)
+        good = isinstance(env, dict) and all(k in env for k in SFT_ENVELOPE_KEYS)
+        ok.append(good)
+        if good: texts.append(messages_to_text(tok, build_sft_messages({"prompt": prompt, "reasoning_md": rm, "eye_tag": tag, "envelope": env})))
+    enc = iter(tok(texts, truncation=True, max_length=CFG.max_seq_len)["input_ids"] if texts else [])
+    ids = [next(enc) if good else [] for good in ok]
+    labels = [[-100 if t == tok.pad_token_id else t for t in x] for x in ids]
+    return ids, labels
+
+def sft_token_cache(tok, rows: List[tuple], batch: int = 4096):
+    """
+    (memory-mapped Arrow table, row indices in `rows` order, stats) for the given SFT rows, tokenizing only
+    rows missing from the cache. Unreferenced rows are compacted away once they outnumber the live ones.
+    """
+    import pyarrow as pa
+    d = CFG.sft_cache_dir / sft_cache_key(tok); d.mkdir(parents=True, exist_ok=True)
+    schema = pa.schema([("key", pa.binary(16)), ("input_ids", pa.list_(pa.int32())),
+                        ("labels", pa.list_(pa.int32())), ("length", pa.int32())])
+    def load():
+        parts = sorted(d.glob("part-*.arrow"))
+        tabs = [pa.ipc.open_file(pa.memory_map(str(p))).read_all() for p in parts]
+        return parts, (pa.concat_tables(tabs) if tabs else schema.empty_table())
+    def write(name: str, t):
+        tmp = d / f"{name}.tmp"
+        with pa.ipc.new_file(str(tmp), schema) as w: w.write_table(t)
+        os.replace(tmp, d / name)
+    parts, table = load()
+    pos = {k: i for i, k in enumerate(table.column("key").to_pylist())}
+    keys = [sft_row_key(*r) for r in rows]
+    todo, queued = [], set()
+    for j, k in enumerate(keys):
+        if k not in pos and k not in queued: queued.add(k); todo.append(j)
+    t0 = time.time(); nxt = int(parts[-1].stem.split("-")[1]) + 1 if parts else 0
+    for b in range(0, len(todo), batch):
+        sel = [rows[j] for j in todo[b:b + batch]]
+        ids, labels = sft_tokenize(tok, sel)
+        write(f"part-{nxt:06d}.arrow", pa.table({"key": [keys[j] for j in todo[b:b + batch]], "input_ids": ids,
+                                                 "labels": labels, "length": [len(x) for x in ids]}, schema=schema))
+        nxt += 1
+    stats = {"cached": len(rows) - sum(1 for k in keys if k not in pos), "tokenized": len(todo), "tokenize_s": time.time() - t0}
+    if todo:
+        parts, table = load(); pos = {k: i for i, k in enumerate(table.column("key").to_pylist())}
+    live = {pos[k] for k in keys}
+    if len(pos) > 2 * len(live):
+        write(f"part-{nxt:06d}.arrow", table.take(sorted(live)))
+        for p in parts: p.unlink()
+        parts, table = load(); pos = {k: i for i, k in enumerate(table.column("key").to_pylist())}
+    length = table.column("length").to_numpy()
+    idx = [pos[k] for k in keys if length[pos[k]] > 0]
+    stats.update(rows=len(idx), invalid=len(keys) - len(idx), cache=str(d))
+    return table, idx, stats
+
+class SFTRows:
+    """Map-style dataset over rows `idx` of the memory-mapped token table; nothing is copied up front."""
+    def __init__(self, table, idx: List[int]):
+        self.ids, self.labels, self.idx = table.column("input_ids"), table.column("labels"), idx
+    def __len__(self): return len(self.idx)
+    def __getitem__(self, i: int) -> dict:
+        j = self.idx[i]
+        return {"input_ids": self.ids[j].values.to_numpy(), "labels": self.labels[j].values.to_numpy()}
+
+class SFTCollator:
+    """Right-pad input_ids with pad_id and labels with -100; attention_mask marks the real tokens."""
+    def __init__(self, pad_id: int): self.pad_id = pad_id
+    def __call__(self, feats: List[dict]) -> dict:
+        import torch
+        n = max(len(f["input_ids"]) for f in feats)
+        ids = torch.full((len(feats), n), self.pad_id, dtype=torch.long)
+        labels = torch.full((len(feats), n), -100, dtype=torch.long)
+        att = torch.zeros((len(feats), n), dtype=torch.long)
+        for i, f in enumerate(feats):
+            L = len(f["input_ids"])
+            ids[i, :L] = torch.tensor(f["input_ids"]); labels[i, :L] = torch.tensor(f["labels"]); att[i, :L] = 1
+        return {"input_ids": ids, "attention_mask": att, "labels": labels}
+
+def pack_examples(rows: List[int], length, capacity: int) -> List[List[int]]:
+    """Best-fit-decreasing bin packing of table rows into packs of at most `capacity` tokens."""
+    import bisect
+    packs: List[List[int]] = []; free: List[tuple] = []   # sorted (room left, pack id)
+    for r in sorted(rows, key=lambda r: -int(length[r])):
+        L = int(length[r])
+        k = bisect.bisect_left(free, (L, -1))
+        if k < len(free):
+            room, b = free.pop(k); packs[b].append(r); bisect.insort(free, (room - L, b))
+        else:
+            packs.append([r]); bisect.insort(free, (capacity - L, len(packs) - 1))
+    return packs
+
+class SFTPacks:
+    """
+    Packed view of the token table: one item per pack, examples concatenated with position ids restarting
+    at 0 and the first label of each example masked, so no token is predicted across a boundary.
+    """
+    def __init__(self, table, packs: List[List[int]]):
+        self.ids, self.labels, self.packs = table.column("input_ids"), table.column("labels"), packs
+    def __len__(self): return len(self.packs)
+    def __getitem__(self, i: int) -> dict:
+        import numpy as np
+        ids = [self.ids[j].values.to_numpy() for j in self.packs[i]]
+        labels = [self.labels[j].values.to_numpy().copy() for j in self.packs[i]]
+        for x in labels: x[0] = -100
+        return {"input_ids": np.concatenate(ids), "labels": np.concatenate(labels),
+                "position_ids": np.concatenate([np.arange(len(x)) for x in ids])}
+
+class SFTPackCollator:
+    """
+    Flatten a batch of packs into one padding-free row. Attention stays inside each example: flash-attention
+    goes varlen on the position-id restarts, sdpa/eager get a block-diagonal causal mask from them (this
+    needs attention_mask=None and no KV cache, hence use_cache=False).
+    """
+    def __call__(self, feats: List[dict]) -> dict:
+        import torch, numpy as np
+        cat = lambda k: torch.tensor(np.concatenate([f[k] for f in feats]), dtype=torch.long)[None]
+        return {"input_ids": cat("input_ids"), "labels": cat("labels"), "position_ids": cat("position_ids"),
+                "use_cache": False}
+
+def packed_attention_supported() -> bool:
+    """transformers derives per-example masks from restarting position ids (masking_utils) — older versions would attend across examples."""
+    try: from transformers.masking_utils import find_packed_sequence_indices
+    except ImportError: return False
+    return True
+
+def padding_report(length, rows: List[int], packs: Optional[List[List[int]]], bsz: int, capacity: int) -> str:
+    """Real tokens / computed token slots: padded random batches of `bsz` vs the packed rows."""
+    import numpy as np
+    L = np.asarray([int(length[r]) for r in rows]); L = L[np.random.default_rng(42).permutation(len(L))]
+    real = int(L.sum())
+    slots = sum(len(b) * int(b.max()) for b in (L[i:i + bsz] for i in range(0, len(L), bsz)))
+    msg = f"Padding efficiency: {real / max(slots, 1):.1%} padded (bsz {bsz}, {-(-len(L) // bsz)} batches)"
+    if packs is not None:
+        msg += (f" → 100.0% packed ({len(packs)} packs of ≤{capacity} tokens, {real / max(len(packs) * capacity, 1):.1%} full, "
+                f"{-(-len(packs) // bsz)} batches)")
+    return msg
+
+class TokenBudgetSampler:
+    """
+    Batch sampler under a token budget: items fall into length buckets `width` tokens wide, and each bucket takes
+    budget // (its upper length) items per batch, so no padded batch exceeds the budget. Buckets are reshuffled
+    every epoch and batch order is shuffled across buckets; the batch count stays fixed (Trainer plans steps on it).
+    """
+    def __init__(self, lengths, budget: int, width: int = 64, seed: int = 42):
+        import numpy as np
+        L = np.asarray(lengths, dtype=np.int64); top = np.maximum(-(-L // width), 1) * width
+        self.lengths, self.budget, self.seed, self.epoch = L, budget, seed, 0
+        self.buckets = [(np.flatnonzero(top == u), max(1, budget // int(u))) for u in np.unique(top)]
+    def __len__(self): return sum(-(-len(ix) // n) for ix, n in self.buckets)
+    def set_epoch(self, epoch: int): self.epoch = epoch
+    def batches(self, epoch: int) -> List[List[int]]:
+        import numpy as np
+        rng = np.random.default_rng((self.seed, epoch))
+        out = []
+        for ix, n in self.buckets:
+            p = rng.permutation(ix); out += [p[i:i + n].tolist() for i in range(0, len(p), n)]
+        return [out[i] for i in rng.permutation(len(out))]
+    def __iter__(self):
+        bs = self.batches(self.epoch); self.epoch += 1
+        return iter(bs)
+    def report(self) -> str:
+        bs = self.batches(0)
+        slots = sum(len(b) * int(self.lengths[b].max()) for b in bs)
+        return (f"Token budget {self.budget}: {len(bs)} batches/epoch of {min(map(len, bs))}–{max(map(len, bs))} items, "
+                f"{int(self.lengths.sum()) / max(slots, 1):.1%} of padded slots are real tokens")
+
+def sft_trainer(batch_sampler=None, **kw):
+    """
+    transformers.Trainer for the student. The loss is the label-token sum over the label tokens of the whole
+    accumulated step (num_items_in_batch), so uneven micro-batches weigh by tokens, not by count. `batch_sampler`
+    replaces the fixed-size train batches; tokens/s per optimizer step goes to LOGSD/train_throughput.jsonl and,
+    averaged, into the trainer logs.
+    """
+    from transformers import Trainer, TrainerCallback
+    class Throughput(TrainerCallback):
+        def __init__(self): self.tokens = self.window = 0; self.t = self.t_window = time.time()
+        def on_train_begin(self, args, state, control, **k): self.t = self.t_window = time.time()
+        def on_step_end(self, args, state, control, **k):
+            now = time.time(); dt = max(now - self.t, 1e-9)
+            if state.is_world_process_zero:
+                with open(LOGSD / "train_throughput.jsonl", "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"ts": int(now), "step": state.global_step, "tokens": self.tokens,
+                                        "s": round(dt, 4), "tok_s": round(self.tokens / dt, 1)}) + "\n")
+            self.window += self.tokens; self.tokens = 0; self.t = now
+        def rate(self) -> float:
+            now = time.time(); r = self.window / max(now - self.t_window, 1e-9)
+            self.window, self.t_window = 0, now
+            return r
+    meter = Throughput()
+    class StudentTrainer(Trainer):
+        def __init__(self, **k):
+            super().__init__(**k); self.add_callback(meter)
+            self.model_accepts_loss_kwargs = True   # causal-LM heads divide by num_items_in_batch; Trainer then skips the /grad_accum
+        def get_train_dataloader(self):
+            if batch_sampler is None: return super().get_train_dataloader()
+            from torch.utils.data import DataLoader
+            return self.accelerator.prepare(DataLoader(self.train_dataset, batch_sampler=batch_sampler, collate_fn=self.data_collator,
+                                                       num_workers=self.args.dataloader_num_workers,
+                                                       pin_memory=self.args.dataloader_pin_memory))
+        def training_step(self, model, inputs, *a, **k):
+            meter.tokens += int(inputs["attention_mask"].sum()) if "attention_mask" in inputs else inputs["input_ids"].numel()
+            return super().training_step(model, inputs, *a, **k)
+        def log(self, logs, *a, **k):
+            if "loss" in logs: logs["tokens_per_s"] = round(meter.rate(), 1)
+            super().log(logs, *a, **k)
+    return StudentTrainer(**kw)
+
+def split_train_eval(n: int, test_size: float = 0.05, seed: int = 42):
+    """Same index split as datasets' train_test_split(test_size, seed)."""
+    import numpy as np
+    perm = np.random.default_rng(seed).permutation(n)
+    n_test = math.ceil(test_size * n)
+    return perm[n_test:].tolist(), perm[:n_test].tolist()
+
 # ------------------------- Summary report -------------------------
 def action_summary():
-    import orjson, pandas as pd
     if not CFG.dataset_jsonl.exists():
         print("Dataset not found:", CFG.dataset_jsonl); return
-    rows = [orjson.loads(l) for l in open(CFG.dataset_jsonl,"r",encoding="utf-8")]
-    if not rows:
+    t = read_dataset(["offset", "eye_tag", "lang", "teacher_id", "elapsed_s", "reasoning_chars", "tokens_saved",
+                      "think_tokens", "think_budget", "invariant_checks"])   # no reasoning / envelope text
+    if not t.num_rows:
         print("Dataset empty."); return
+    cols = t.to_pydict()
+    rows = [dict(zip(cols, v)) for v in zip(*cols.values())]
 
     # Core aggregates
     total = len(rows)
@@ -386,18 +1949,22 @@ def action_summary():
     per_teacher = {}
     latency = []
     think_len = []
+    saved_tok = []
+    think_tok = []; budget_hits = 0
     inv_fail = {}
 
     for r in rows:
-        env = r.get("envelope", {})
-        tag = (env.get("tag") or r.get("eye_tag") or "").upper()
+        tag = (r["eye_tag"] or "").upper()   # = envelope tag
         per_eye[tag] = per_eye.get(tag,0)+1
-        lang = r.get("lang","en"); per_lang[lang] = per_lang.get(lang,0)+1
-        tid = r.get("teacher_id","?"); per_teacher[tid] = per_teacher.get(tid,0)+1
-        latency.append(r.get("elapsed_s",0.0))
-        think_len.append(len(r.get("reasoning_md","")))
-        inv = r.get("invariant_checks",{})
-        for k,v in inv.items():
+        lang = r["lang"] or "en"; per_lang[lang] = per_lang.get(lang,0)+1
+        tid = r["teacher_id"] or "?"; per_teacher[tid] = per_teacher.get(tid,0)+1
+        latency.append(r["elapsed_s"] or 0.0)
+        think_len.append(r["reasoning_chars"])
+        if r["tokens_saved"] is not None: saved_tok.append(r["tokens_saved"])
+        if r["think_tokens"] is not None:
+            think_tok.append(r["think_tokens"])
+            if r["think_budget"] and r["think_tokens"] >= r["think_budget"]: budget_hits += 1
+        for k,v in r["invariant_checks"] or []:
             if v is True: inv_fail[k] = inv_fail.get(k,0)+1
 
     import numpy as np
@@ -408,7 +1975,7 @@ def action_summary():
             "p90":  float(np.percentile(x,90)) if x else 0.0,
             "max":  float(np.max(x)) if x else 0.0
         }
-    lat = s(latency); thk = s(think_len)
+    lat = s(latency); thk = s(think_len); stp = s(saved_tok); ttk = s(think_tok)
 
     summary = {
         "total_rows": total,
@@ -417,6 +1984,8 @@ def action_summary():
         "per_teacher": per_teacher,
         "latency_s": lat,
         "reasoning_chars": thk,
+        "think_tokens": {**ttk, "budget_hits": budget_hits},
+        "tokens_saved": {**stp, "total": int(sum(saved_tok)), "rows": len(saved_tok)},
         "invariant_hits": inv_fail
     }
     # Save JSON
@@ -433,6 +2002,8 @@ def action_summary():
           *[f"- {k}: {v}" for k,v in per_teacher.items()],
           "## Latency (s)", f"- mean: {lat['mean']:.2f} | p50: {lat['p50']:.2f} | p90: {lat['p90']:.2f} | max: {lat['max']:.2f}",
           "## Reasoning length (chars)", f"- mean: {thk['mean']:.0f} | p50: {thk['p50']:.0f} | p90: {thk['p90']:.0f} | max: {thk['max']:.0f}",
+          "## Reasoning length (tokens)", f"- mean: {ttk['mean']:.0f} | p50: {ttk['p50']:.0f} | p90: {ttk['p90']:.0f} | max: {ttk['max']:.0f} | hit budget: {budget_hits}",
+          "## Tokens saved by early envelope stop", f"- total: {int(sum(saved_tok))} over {len(saved_tok)} rows | mean: {stp['mean']:.0f} | p50: {stp['p50']:.0f} | p90: {stp['p90']:.0f}",
           "## Invariant checks (true hits)",
           *[f"- {k}: {v}" for k,v in sorted(inv_fail.items())]
          ]
@@ -554,15 +2125,14 @@ def action_hf_login():
 
 def action_clean():
     safe_imports()
-    global PROMPTS
-    PROMPTS = run_clean_prompts()
-    print("PROMPTS:", len(PROMPTS))
+    n = run_clean_prompts()
+    PROMPTS[:] = []   # later steps re-read prompts_clean.parquet
+    print("PROMPTS:", n)
 
 def action_dryrun():
     safe_imports()
-    import pandas as pd
     if not PROMPTS and CFG.prompts_clean_csv.exists():
-        PROMPTS[:] = pd.read_csv(CFG.prompts_clean_csv)["Prompt"].astype(str).tolist()
+        PROMPTS[:] = load_clean_prompts()
     tests = PROMPTS[:CFG.dryrun_samples] if PROMPTS else [
         "تحدث عن إنجازات علماء الفلك المسلمين مثل البيروني والخوارزمي",
         "Explain exponential backoff with jitter for a notification service."
@@ -575,41 +2145,690 @@ def action_dryrun():
         if res["json"]: print("✅ keys:", list(res["json"].keys())); ok+=1
         else: print("❌ Invalid JSON excerpt:", res["raw"][:500], "…")
     if ok==0: print("❌ Dry-run failed. Do not continue.")
+    if CFG.teacher_cache: print(teacher_cache().report())
+    print(MODELS.report())
+
+def bench_prompts() -> List[str]:
+    return PROMPTS[:CFG.bench_samples] if PROMPTS else [
+        "تحدث عن إنجازات علماء الفلك المسلمين مثل البيروني والخوارزمي",
+        "Explain exponential backoff with jitter for a notification service.",
+        "Fix the flaky retry test in the billing module."]
+
+def action_bench_clean():
+    """Throughput of the scalar clean_chunk vs the column-wise clean_chunk_arrow (equality: tests/test_training_cli.py)."""
+    safe_imports()
+    rows: List[str] = []
+    for fp in [CFG.english1, CFG.arabic1, CFG.english2, CFG.arabic2]:
+        if not fp.exists(): continue
+        for chunk in iter_csv_prompts(fp):
+            rows += chunk[:CFG.clean_chunk_rows // 4]; break   # first chunk of each source
+    if not rows: print("No source CSVs found."); return
+    print(f"Corpus: {len(rows)} rows ({sum(detect_lang(r) == 'ar' for r in rows)} Arabic)")
+    for name, fn in (("python", clean_chunk), ("arrow", clean_chunk_arrow)):
+        t0 = time.time(); st, out = fn(0, rows, CFG.arabic_norm); dt = time.time() - t0
+        print(f"  {name:<7} {dt:.2f}s → {len(rows)/max(dt,1e-9):,.0f} rows/s | kept {sum(r[1] is not None for r in out)}")
+
+def action_bench_constrained():
+    """Invalid-envelope rate and tokens/s: free vs grammar-constrained teacher decoding (cache bypassed)."""
+    safe_imports()
+    prompts = bench_prompts()
+    saved = (CFG.constrained_json, CFG.teacher_cache)
+    CFG.teacher_cache = False
+    rows = []
+    try:
+        for constrained in (False, True):
+            CFG.constrained_json = constrained
+            t0 = time.time(); res = ask_teacher_batch(prompts); dt = time.time()-t0
+            bad = sum(not envelope_ok(r["json"]) for r in res)
+            toks = sum(r.get("gen_tokens") or 0 for r in res)
+            rows.append(("constrained" if constrained else "free", bad, toks, dt))
+    finally:
+        CFG.constrained_json, CFG.teacher_cache = saved
+    n = len(prompts)
+    for name, bad, toks, dt in rows:
+        print(f"  {name:<11} invalid {bad}/{n} ({bad/n*100:.0f}%) | {toks} tok in {dt:.1f}s → {toks/max(dt,1e-9):.1f} tok/s")
+
+def action_bench_prefix_cache():
+    """Greedy outputs with vs without the persona prefix cache (must match) + prefill time per prompt."""
+    safe_imports()
+    torch = __import__('torch')
+    def sync():
+        if torch.cuda.is_available(): torch.cuda.synchronize()
+    prompts = bench_prompts()
+    for kind, ps in build_teacher_queues(prompts).items():
+        tokX, mdl = load_teacher(kind); persona, _ = teacher_profile(kind); teacher_id = MODELS.source(kind)
+        chats = [teacher_chat(tokX, persona, p) for p in ps]
+        drop_prefix_cache(kind)
+        sync(); t0 = time.time(); prefix = persona_prefix(kind, tokX, mdl, persona); sync(); build_s = time.time()-t0
+        if prefix is None: print(f"[{kind}] prefix cache unavailable (prefix_cache off or no shared prefix)"); continue
+        P = len(prefix.ids); full_s = suffix_s = 0.0
+        with torch.inference_mode():
+            for c in chats:
+                ids = tokX(c).input_ids
+                sync(); t0 = time.time(); mdl(input_ids=torch.tensor([ids], device=mdl.device)); sync(); full_s += time.time()-t0
+                past = prefix.expand(1)
+                sync(); t0 = time.time(); mdl(input_ids=torch.tensor([ids[P:]], device=mdl.device), past_key_values=past); sync(); suffix_s += time.time()-t0
+        plain, _, _  = _generate_rows(tokX, mdl, chats, CFG.max_new_tokens, None)
+        cached, _, _ = _generate_rows(tokX, mdl, chats, CFG.max_new_tokens, prefix)
+        same = sum(a == b for a,b in zip(plain, cached))
+        n = len(chats)
+        print(f"[{kind}] {teacher_id}: prefix {P} tok (built once in {build_s:.3f}s)")
+        print(f"  prefill/prompt: full {full_s/n*1000:.1f} ms → cached {suffix_s/n*1000:.1f} ms "
+              f"({(1 - suffix_s/max(full_s,1e-9))*100:.0f}% saved)")
+        print(f"  greedy outputs identical: {same}/{n}" + ("" if same == n else "  ⚠ mismatch"))
+
+# ------------------------- Per-teacher label queues -------------------------
+TEACHER_ORDER = ["general", "coder"]
+
+def build_teacher_queues(pending: List[str]) -> Dict[str,List[str]]:
+    """Partition pending prompts by routed teacher (variations ride with their base prompt)."""
+    queues: Dict[str,List[str]] = {}
+    for p in pending: queues.setdefault(route_teacher(p), []).append(p)
+    return queues
+
+def load_queue_ckpt() -> dict:
+    if CFG.queue_ckpt.exists():
+        try: return json.loads(CFG.queue_ckpt.read_text(encoding="utf-8"))
+        except Exception: pass
+    return {"active": None, "queues": {}}
+
+def save_queue_ckpt(ckpt: dict):
+    tmp = CFG.queue_ckpt.with_suffix(".tmp")
+    tmp.write_text(json.dumps(ckpt, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, CFG.queue_ckpt)
+
+def key_hash(prompt: str) -> int:
+    """64-bit blake2b of the canonical key: stable across runs, processes and PYTHONHASHSEED."""
+    import hashlib
+    return int.from_bytes(hashlib.blake2b(canonical_key(prompt).encode("utf-8"), digest_size=8).digest(), "little")
+
+class SeenIndex:
+    """
+    Prompts whose base record is written, as 8-byte key hashes: a sorted uint64 array on disk
+    (np.fromfile → binary search) plus an append-only log of newer hashes. The log is folded
+    into the array when it outgrows max(64k, base/16) entries; a torn 8-byte tail is ignored.
+    """
+    def __init__(self, path: Path, legacy_txt: Optional[Path] = None):
+        import numpy as np
+        self.path, self.log_path = path, path.with_suffix(".log")
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            hs = []
+            if legacy_txt is not None and legacy_txt.exists():   # one-shot migration from seen_prompts.txt
+                with open(legacy_txt, "r", encoding="utf-8") as f:
+                    hs = [key_hash(ln.strip()) for ln in f if ln.strip()]
+                print(f"Seen-index: migrated {len(hs)} prompts from {legacy_txt.name}")
+            self._write(np.unique(np.array(hs, dtype="<u8")))
+        self.base = np.fromfile(path, dtype="<u8")
+        self.new: set = set()
+        if self.log_path.exists():
+            raw = self.log_path.read_bytes()
+            self.new = set(np.frombuffer(raw[:len(raw) // 8 * 8], dtype="<u8").tolist())
+        self.log = open(self.log_path, "ab")
+        if self.log.tell() % 8: self.log.truncate(self.log.tell() // 8 * 8); self.log.seek(0, 2)
+        if self._full(): self.compact()
+
+    def _full(self) -> bool: return len(self.new) > max(65536, len(self.base) // 16)
+
+    def _write(self, arr):
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "wb") as f: arr.astype("<u8").tofile(f); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _has(self, h: int) -> bool:
+        import numpy as np
+        if h in self.new: return True
+        i = int(np.searchsorted(self.base, np.uint64(h)))
+        return i < len(self.base) and int(self.base[i]) == h
+
+    def __contains__(self, prompt: str) -> bool: return self._has(key_hash(prompt))
+    def __len__(self) -> int: return len(self.base) + len(self.new)
+
+    def add(self, prompt: str): self.add_hash(key_hash(prompt))
+
+    def add_hash(self, h: int):
+        if self._has(h): return
+        self.new.add(h); self.log.write(h.to_bytes(8, "little"))
+        if self._full(): self.compact()
+
+    def discard(self, hashes):
+        """Remove hashes (rewrites the array, so meant for rare repairs rather than the hot path)."""
+        import numpy as np
+        hashes = np.asarray(hashes, dtype="<u8")
+        self.new -= set(hashes.tolist())
+        self.base = np.setdiff1d(self.base, hashes); self.compact()
+
+    def hashes(self):
+        import numpy as np
+        return np.union1d(self.base, np.array(sorted(self.new), dtype="<u8"))
+
+    def sync(self):
+        self.log.flush(); os.fsync(self.log.fileno())
+
+    def compact(self):
+        """Fold the log into the sorted array (atomic replace), then empty the log."""
+        self.sync()
+        self.base = self.hashes(); self._write(self.base)
+        self.new = set(); self.log.truncate(0); self.log.seek(0); self.sync()
+
+    def close(self):
+        if not self.log.closed: self.sync(); self.log.close()
+
+class DatasetIndex:
+    """
+    SQLite side-index of the dataset JSONL: per line its byte offset and length plus the fields worth
+    filtering on (canonical-key hash of the prompt, variation, eye_tag, lang, teacher_id, json_valid, ts)
+    and the invariant flags that fired. DatasetWriter adds rows in the commit that appends their lines;
+    sync() catches up on lines written without it and rebuilds after the JSONL was replaced or rewound.
+    """
+    def __init__(self, path: Path, db_path: Path):
+        import sqlite3
+        self.path = path
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta(k TEXT PRIMARY KEY, v TEXT);
+            CREATE TABLE IF NOT EXISTS rows(pos INTEGER PRIMARY KEY, nbytes INTEGER, prompt_hash INTEGER,
+                variation INTEGER, eye_tag TEXT, lang TEXT, teacher_id TEXT, json_valid INTEGER, ts INTEGER);
+            CREATE TABLE IF NOT EXISTS flags(flag TEXT, pos INTEGER, PRIMARY KEY(flag, pos)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS rows_prompt ON rows(prompt_hash);
+            CREATE INDEX IF NOT EXISTS rows_eye_lang ON rows(eye_tag, lang);
+            CREATE INDEX IF NOT EXISTS rows_teacher ON rows(teacher_id);
+            CREATE INDEX IF NOT EXISTS rows_ts ON rows(ts);""")
+        self.db.commit()
+        r = self.db.execute("SELECT v FROM meta WHERE k = 'state'").fetchone()
+        self.state: dict = json.loads(r[0]) if r else {}
+
+    @staticmethod
+    def _hash(prompt: str) -> int:   # key_hash as a signed 64-bit SQLite integer
+        h = key_hash(prompt)
+        return h - (1 << 64) if h >= 1 << 63 else h
+
+    def _insert(self, pos: int, lines: List[bytes], recs: List[Optional[dict]]):
+        rows, flags = [], []
+        for line, rec in zip(lines, recs):
+            if rec is not None:
+                prompt, var = rec.get("prompt") or "", rec.get("variation")
+                if var is None:
+                    m = _VARIATION.search(prompt.strip()); var = int(m.group(1)) if m else 0
+                rows.append((pos, len(line), self._hash(prompt), var, rec.get("eye_tag"), rec.get("lang"),
+                             rec.get("teacher_id"), int(bool(rec.get("json_valid"))), rec.get("ts")))
+                flags += [(k, pos) for k, v in (rec.get("invariant_checks") or {}).items() if v is True]
+            pos += len(line)
+        self.db.executemany("INSERT OR REPLACE INTO rows VALUES (?,?,?,?,?,?,?,?,?)", rows)
+        self.db.executemany("INSERT OR REPLACE INTO flags VALUES (?,?)", flags)
+        fst = self.path.stat()
+        self.state = {"offset": pos, "dev": fst.st_dev, "ino": fst.st_ino, "tail": tail_digest(self.path, pos)}
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('state', ?)", (json.dumps(self.state),))
+        self.db.commit()
+
+    def add(self, pos: int, lines: List[bytes], recs: List[dict]):
+        """Index lines just appended at `pos` (DatasetWriter, after the flush)."""
+        if pos == self.state.get("offset"): self._insert(pos, lines, recs)
+        else: self.sync()   # lines appended behind our back: pick them up together with these
+
+    def sync(self, batch: int = 50_000) -> Dict[str,int]:
+        """Index complete lines past the last indexed offset; a replaced or rewound JSONL is re-indexed from 0."""
+        import orjson
+        stats = {"indexed": 0, "bad": 0, "rebuilt": 0}
+        fst = self.path.stat() if self.path.exists() else None
+        off = self.state.get("offset", 0)
+        if fst is None or [self.state.get("dev"), self.state.get("ino")] != [fst.st_dev, fst.st_ino] \
+                or off > fst.st_size or tail_digest(self.path, off) != self.state.get("tail"):
+            stats["rebuilt"] = int(bool(self.state))
+            self.db.execute("DELETE FROM rows"); self.db.execute("DELETE FROM flags"); self.db.commit()
+            self.state, off = {}, 0
+            if fst is None: return stats
+        with open(self.path, "rb") as f:
+            f.seek(off); lines, recs = [], []
+            for line in f:
+                if not line.endswith(b"\n"): break   # a row still being written
+                try: recs.append(orjson.loads(line))
+                except orjson.JSONDecodeError: recs.append(None); stats["bad"] += 1
+                lines.append(line)
+                if len(lines) >= batch: self._insert(off, lines, recs); off += sum(map(len, lines)); lines, recs = [], []
+            if lines or off != self.state.get("offset"): self._insert(off, lines, recs)
+        stats["indexed"] = self.db.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+        return stats
+
+    def query(self, eye_tag: Optional[str] = None, lang: Optional[str] = None, teacher_id: Optional[str] = None,
+              json_valid: Optional[bool] = None, flag: Optional[str] = None, prompt: Optional[str] = None,
+              variation: Optional[int] = None, since: Optional[int] = None, until: Optional[int] = None) -> List[tuple]:
+        """(offset, length) of matching rows in file order. `prompt` matches by canonical key, variations included."""
+        where, args = [], []
+        for col, v in (("eye_tag", eye_tag), ("lang", lang), ("teacher_id", teacher_id), ("variation", variation)):
+            if v is not None: where.append(f"{col} = ?"); args.append(v)
+        if json_valid is not None: where.append("json_valid = ?"); args.append(int(json_valid))
+        if prompt is not None: where.append("prompt_hash = ?"); args.append(self._hash(prompt))
+        if flag is not None: where.append("pos IN (SELECT pos FROM flags WHERE flag = ?)"); args.append(flag)
+        if since is not None: where.append("ts >= ?"); args.append(since)
+        if until is not None: where.append("ts < ?"); args.append(until)
+        sql = "SELECT pos, nbytes FROM rows" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY pos"
+        return self.db.execute(sql, args).fetchall()
+
+    def read(self, hits: List[tuple]) -> Iterator[dict]:
+        """Seek to and decode only the given rows."""
+        import orjson
+        with open(self.path, "rb") as f:
+            for pos, n in hits:
+                f.seek(pos); yield orjson.loads(f.read(n))
+
+    def close(self):
+        self.db.close()
+
+def parse_filter(spec: str) -> Dict[str,Any]:
+    """"eye_tag=TENSEIGAN lang=ar json_valid=true" → DatasetIndex.query kwargs."""
+    out: Dict[str,Any] = {}
+    for kv in spec.replace(",", " ").split():
+        k, _, v = kv.partition("=")
+        out[k] = v.lower() in ("1", "true", "yes") if k == "json_valid" else int(v) if k in ("variation", "since", "until") else v
+    return out
+
+def query_dataset(**filters) -> List[dict]:
+    """Rows matching DatasetIndex.query(**filters), decoded from just their byte ranges of the JSONL."""
+    idx = DatasetIndex(CFG.dataset_jsonl, CFG.dataset_index)
+    try:
+        idx.sync()
+        return list(idx.read(idx.query(**filters)))
+    finally:
+        idx.close()
+
+class DatasetWriter:
+    """
+    Background group-commit writer for labeled rows. The labeling loop only enqueues; this
+    thread serializes with orjson and appends a batch (write_batch_rows / write_batch_ms),
+    then records the batch's seen prompts, so the seen-index never gets ahead of the dataset.
+    fsync per CFG.write_durability. close() drains everything still queued.
+    """
+    _STOP = object()
+
+    def __init__(self, path: Path, seen: SeenIndex, index: Optional[DatasetIndex] = None):
+        import queue, threading
+        self.path, self.seen, self.index = path, seen, index
+        self.q: "queue.Queue" = queue.Queue(maxsize=max(1, CFG.write_queue_max))
+        self.f = open(path, "ab"); self.pos = self.f.tell()
+        self.err: Optional[BaseException] = None
+        self.stats = {"rows": 0, "batches": 0, "fsyncs": 0, "max_depth": 0, "put_wait_s": 0.0}
+        self.last_sync, self.dirty = time.time(), False
+        self.t = threading.Thread(target=self._run, name="dataset-writer", daemon=True); self.t.start()
+
+    def put(self, rec: Optional[dict] = None, seen: Optional[str] = None):
+        """Queue a row and/or a prompt to mark seen (after everything queued before it is written)."""
+        import queue
+        t0 = time.time()
+        while True:   # a dead writer stops draining: re-check it instead of blocking on a full queue forever
+            if self.err is not None or not self.t.is_alive(): raise RuntimeError("dataset writer failed") from self.err
+            try: self.q.put((rec, seen), timeout=0.5); break
+            except queue.Full: pass
+        self.stats["put_wait_s"] += time.time() - t0
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.q.qsize())
+
+    def _run(self):
+        import queue, orjson
+        stop = False
+        while not stop:
+            try: items = [self.q.get(timeout=CFG.write_fsync_s)]
+            except queue.Empty:   # idle: settle a "periodic" fsync that came due
+                if self.dirty and CFG.write_durability == "periodic": self._fsync()
+                continue
+            deadline = time.time() + CFG.write_batch_ms / 1000
+            while len(items) < CFG.write_batch_rows and items[-1] is not self._STOP:
+                try: items.append(self.q.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty: break
+            if items[-1] is self._STOP: stop = True; items.pop()
+            try: self._commit(items, orjson)
+            except BaseException as e: self.err = e; return
+
+    def _commit(self, items, orjson):
+        recs = [rec for rec, _ in items if rec is not None]
+        rows = [orjson.dumps(rec) + b"\n" for rec in recs]
+        if rows: self.f.write(b"".join(rows)); self.stats["rows"] += len(rows); self.dirty = True
+        self.f.flush(); self.stats["batches"] += 1
+        if rows and self.index is not None: self.index.add(self.pos, rows, recs)
+        self.pos += sum(map(len, rows))
+        for _, p in items:
+            if p is not None: self.seen.add(p); self.dirty = True
+        mode = CFG.write_durability
+        if mode == "batch" or (mode == "periodic" and time.time() - self.last_sync >= CFG.write_fsync_s):
+            self._fsync()
+
+    def _fsync(self):
+        """Dataset first, then the seen log, so a durable seen mark always has its row on disk."""
+        os.fsync(self.f.fileno()); self.seen.sync()
+        self.stats["fsyncs"] += 1; self.last_sync = time.time(); self.dirty = False
+
+    def close(self):
+        """Drain the queue, fsync, and close; re-raises a writer-thread failure."""
+        if self.t.is_alive(): self.q.put(self._STOP); self.t.join()
+        if not self.f.closed:
+            self.f.flush(); self._fsync(); self.f.close()
+        if self.err is not None: raise RuntimeError("dataset writer failed") from self.err
+
+    def report(self) -> str:
+        s = self.stats
+        return (f"Writer [{CFG.write_durability}]: {s['rows']} rows in {s['batches']} commits, {s['fsyncs']} fsyncs | "
+                f"max queue {s['max_depth']}/{CFG.write_queue_max}, labeling blocked {s['put_wait_s']:.2f}s")
+
+def recover_dataset(path: Path, seen: SeenIndex) -> Dict[str,int]:
+    """
+    Startup repair after a crash. Scans the dataset from the byte offset verified last time
+    (sidecar <dataset>.recovery.json; a rewritten/shrunk file is rescanned from 0), truncates
+    trailing torn or unparsable lines, and appends the base prompts found to <dataset>.keys.u64.
+    Then reconciles with the seen-index: base rows not marked seen get marked, seen prompts
+    with no base row (lost with the torn tail) are unmarked so they are labeled again.
+    """
+    import numpy as np, orjson
+    ck_path, keys_path = path.with_suffix(".recovery.json"), path.with_suffix(".keys.u64")
+    stats = {"scanned_mb": 0, "rows": 0, "bad": 0, "truncated_bytes": 0, "marked_seen": 0, "unmarked_seen": 0}
+    if not path.exists(): return stats
+    ck = {}
+    if ck_path.exists():
+        try: ck = json.loads(ck_path.read_text(encoding="utf-8"))
+        except Exception: ck = {}
+    fst = path.stat()
+    off = int(ck.get("offset", 0))
+    if (ck.get("dev"), ck.get("ino")) != (fst.st_dev, fst.st_ino) or off > fst.st_size or ck.get("tail") != tail_digest(path, off):
+        off = 0
+        if keys_path.exists(): keys_path.unlink()
+    keys, good, bad_tail = [], off, 0
+    with open(path, "r+b") as f:
+        f.seek(off); pos = off
+        for line in f:
+            pos += len(line)
+            try:
+                if not line.endswith(b"\n"): raise ValueError("torn line")
+                rec = orjson.loads(line)
+            except Exception:
+                bad_tail += 1; continue
+            stats["bad"] += bad_tail; bad_tail = 0   # garbage followed by valid rows stays; only the tail is cut
+            stats["rows"] += 1; good = pos
+            prompt, var = rec.get("prompt", ""), rec.get("variation")
+            if var == 0 or (var is None and not _VARIATION.search(prompt.strip())): keys.append(key_hash(prompt))
+        stats["scanned_mb"] = round((pos - off) / 1e6, 1)
+        if good < pos:
+            f.truncate(good); f.flush(); os.fsync(f.fileno()); stats["truncated_bytes"] = pos - good
+    if keys:
+        with open(keys_path, "ab") as kf:
+            np.array(keys, dtype="<u8").tofile(kf); kf.flush(); os.fsync(kf.fileno())
+    fst = path.stat()
+    tmp = ck_path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"offset": good, "dev": fst.st_dev, "ino": fst.st_ino, "tail": tail_digest(path, good),
+                               "ts": int(time.time())}), encoding="utf-8")
+    os.replace(tmp, ck_path)
+
+    dk = np.unique(np.fromfile(keys_path, dtype="<u8")) if keys_path.exists() else np.zeros(0, dtype="<u8")
+    sk = seen.hashes()
+    for h in np.setdiff1d(dk, sk).tolist(): seen.add_hash(h); stats["marked_seen"] += 1
+    orphans = np.setdiff1d(sk, dk)
+    if len(orphans): seen.discard(orphans); stats["unmarked_seen"] = len(orphans)
+    seen.sync()
+    return stats
+
+def note_think_budget(st: dict, res: dict, valid: bool):
+    """JSON validity per think budget, split by rows that ran into the budget."""
+    budget = res.get("think_budget", 0) or 0
+    b = st.setdefault("think", {}).setdefault(str(budget), {"rows": 0, "valid": 0, "hit_budget": 0, "hit_valid": 0})
+    hit = budget > 0 and (res.get("think_tokens") or 0) >= budget
+    b["rows"] += 1; b["valid"] += int(valid); b["hit_budget"] += int(hit); b["hit_valid"] += int(hit and valid)
+
+def note_aug(st: dict, res: dict, base: bool):
+    """Per-prompt augmentation cost: teacher seconds over base + variations, and prefill seconds not repeated."""
+    a = st.setdefault("aug", {"prompts": 0, "teacher_s": 0.0, "saved_s": 0.0})
+    a["prompts"] += int(base)
+    if not res.get("cache_hit"): a["teacher_s"] += res.get("elapsed_s") or 0.0
+    a["saved_s"] += res.get("prefill_saved_s") or 0.0
+
+def label_queue(kind: str, prompts: List[str], writer: DatasetWriter, st: dict, ckpt: dict, pbar=None):
+    """Drain one teacher's queue in pools of label_batch_size * label_bucket_pool prompts."""
+    import orjson
+    pool = max(1, CFG.label_batch_size) * max(1, CFG.label_bucket_pool)
+    q = ckpt["queues"].setdefault(kind, {})
+    q.update({"pending": len(prompts), "done": 0, "saved": 0, "started_ts": int(time.time())})
+    ckpt["active"] = kind; save_queue_ckpt(ckpt)
+    n_aug = max(0, CFG.aug_per_prompt)
+    for b in range(0, len(prompts), pool):
+        chunk = prompts[b:b+pool]
+        if CFG.aug_mode == "sample":
+            results = iter([(p, r) for p, res in zip(chunk, ask_teacher_batch(chunk, n_aug=n_aug))
+                            for r in [res] + res.get("samples", [])])
+        else:
+            texts = []
+            for p in chunk: texts += [p] + [f"{p} (variation {n+1})" for n in range(n_aug)]
+            results = iter(zip(texts, ask_teacher_batch(texts)))
+        for p in chunk:
+            envs = set(); base_ok = False
+            for k in range(1 + n_aug):
+                text, res = next(results)
+                note_aug(st, res, k == 0)
+                env_b = orjson.dumps(res["json"], option=orjson.OPT_SORT_KEYS) if res["json"] else None
+                if env_b is not None and env_b in envs:
+                    st["aug_dups"] = st.get("aug_dups", 0) + 1; continue   # byte-identical to an earlier row
+                envs.add(env_b)
+                rec = make_labeled_record(text, res)
+                note_think_budget(st, res, rec is not None)
+                if rec:
+                    rec["variation"] = k
+                    writer.put(rec); st["saved"]+=1; q["saved"]+=1; st["bad"]=0
+                    base_ok = base_ok or k == 0
+                else:
+                    st["bad"]+=1
+                    if st["bad"]>=CFG.early_stop: print("Too many invalids — stopping."); st["stop"] = True; break
+            if base_ok: writer.put(seen=p)   # after the prompt's rows, so a crash can't mark it seen early
+            q["done"]+=1
+            if pbar is not None: pbar.update(1)
+            if st["stop"]: break
+        if st["saved"] - st["synced"] >= CFG.save_every:
+            st["synced"] = st["saved"]; save_queue_ckpt(ckpt)
+        if st["stop"]: break
+    save_queue_ckpt(ckpt)
 
 def action_label():
     safe_imports()
-    import pandas as pd, orjson
     if not PROMPTS and CFG.prompts_clean_csv.exists():
-        PROMPTS[:] = pd.read_csv(CFG.prompts_clean_csv)["Prompt"].astype(str).tolist()
+        PROMPTS[:] = load_clean_prompts()
     if not PROMPTS: print("No prompts. Run [3] Clean first."); return
 
-    seen = set()
-    if CFG.seen_file.exists():
-        seen = {ln.strip() for ln in CFG.seen_file.read_text(encoding="utf-8").splitlines() if ln.strip()}
-    saved = 0; bad_consec = 0
+    seen = SeenIndex(CFG.seen_index, CFG.seen_file)
+    rs = recover_dataset(CFG.dataset_jsonl, seen)
+    if rs["truncated_bytes"] or rs["bad"] or rs["marked_seen"] or rs["unmarked_seen"]:
+        print(f"Recovery: scanned {rs['scanned_mb']} MB ({rs['rows']} rows) | truncated {rs['truncated_bytes']} torn bytes | "
+              f"{rs['bad']} bad lines kept mid-file | seen-index +{rs['marked_seen']} / -{rs['unmarked_seen']}")
+    queues = build_teacher_queues([p for p in PROMPTS if p not in seen])
+    ckpt = load_queue_ckpt()
+    order = sorted(queues, key=lambda k: (k != ckpt.get("active"), TEACHER_ORDER.index(k)))
+    for k in order: print(f"  queue {k}: {len(queues[k])} pending")
+    st = {"saved": 0, "synced": 0, "bad": 0, "stop": False}
+    index = DatasetIndex(CFG.dataset_jsonl, CFG.dataset_index)
+    ix = index.sync()
+    if ix["rebuilt"]: print(f"Dataset index rebuilt: {ix['indexed']} rows")
     from tqdm.auto import tqdm
-    with open(CFG.dataset_jsonl,"a",encoding="utf-8") as outf, open(CFG.seen_file,"a",encoding="utf-8") as seenf:
-        for p in tqdm(PROMPTS, desc="Labeling"):
-            if p in seen: continue
-            res = ask_teacher(p)
-            rec = make_labeled_record(p, res)
-            if rec:
-                outf.write(orjson.dumps(rec).decode()+"\n")
-                seenf.write(p+"\n"); seen.add(p); saved+=1; bad_consec=0
-            else:
-                bad_consec+=1
-                if bad_consec>=CFG.early_stop: print("Too many invalids — stopping."); break
-            for n in range(CFG.aug_per_prompt):
-                aug = f"{p} (variation {n+1})"
-                res2 = ask_teacher(aug)
-                rec2 = make_labeled_record(aug, res2)
-                if rec2: outf.write(orjson.dumps(rec2).decode()+"\n"); saved+=1; bad_consec=0
-                else:
-                    bad_consec+=1
-                    if bad_consec>=CFG.early_stop: print("Too many invalids — stopping."); break
-            if saved and saved % CFG.save_every == 0:
-                outf.flush(); seenf.flush(); os.fsync(outf.fileno()); os.fsync(seenf.fileno())
-    print("Saved:", saved, "rows →", CFG.dataset_jsonl)
+    writer = DatasetWriter(CFG.dataset_jsonl, seen, index)
+    try:
+        for kind in order:
+            pbar = tqdm(total=len(queues[kind]), desc=f"Labeling [{kind}]")
+            label_queue(kind, queues[kind], writer, st, ckpt, pbar)
+            pbar.close()
+            if st["stop"]: break
+            unload_teacher(kind)   # drained → free memory before the next teacher loads
+    except KeyboardInterrupt:
+        print("\nInterrupted — draining the writer queue …"); st["stop"] = True
+    finally:
+        writer.close(); seen.close(); index.close()
+    print(writer.report())
+    if not st["stop"]: ckpt["active"] = None
+    save_queue_ckpt(ckpt)
+    print("Saved:", st["saved"], "rows →", CFG.dataset_jsonl)
+    if st.get("aug", {}).get("prompts"):
+        a = st["aug"]; n = a["prompts"]
+        print(f"  augmentation [{CFG.aug_mode}] ×{CFG.aug_per_prompt}: {st.get('aug_dups',0)} byte-identical variations dropped | "
+              f"{a['teacher_s']/n:.2f} teacher-s/prompt, {a['saved_s']/n:.2f} s/prompt saved by the shared prefill")
+    if st.get("think"):
+        for budget, b in sorted(st["think"].items(), key=lambda kv: int(kv[0])):
+            print(f"  think budget {budget}: {b['valid']}/{b['rows']} valid | hit budget {b['hit_budget']} "
+                  f"({b['hit_valid']} valid)")
+        with open(LOGSD / "think_budget.jsonl", "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": int(time.time()), "budgets": CFG.think_budget, "stats": st["think"]}) + "\n")
+    if CFG.teacher_cache: print(teacher_cache().report())
+    print(MODELS.report())
+    return not st["stop"]
+
+# ------------------------- Sharded labeling -------------------------
+_VARIATION = re.compile(r"\(variation\s+(\d+)\)$", re.IGNORECASE)
+
+def shard_of(prompt: str, n: int) -> int:
+    """Stable shard index from the canonical-key hash (independent of PYTHONHASHSEED and input order)."""
+    return key_hash(prompt) % n
+
+def shard_paths(i: int, n: int) -> Dict[str,Path]:
+    stem = f"shard-{i:02d}-of-{n:02d}"
+    return {"dataset": CFG.shards_dir / f"{stem}.jsonl", "seen": CFG.shards_dir / f"{stem}.seen.u64",
+            "ckpt": CFG.shards_dir / f"{stem}.queues.json", "done": CFG.shards_dir / f"{stem}.done",
+            "index": CFG.shards_dir / f"{stem}.index.sqlite",
+            "log": LOGSD / f"label-{stem}.log"}
+
+def visible_gpus() -> List[str]:
+    """CUDA_VISIBLE_DEVICES entries a shard can be pinned to ([] without CUDA)."""
+    import torch
+    if not (torch.cuda.is_available() and torch.cuda.device_count()): return []
+    vis = [d.strip() for d in os.environ.get("CUDA_VISIBLE_DEVICES", "").split(",") if d.strip()]
+    return vis or [str(d) for d in range(torch.cuda.device_count())]
+
+def shard_env(i: int, n: int) -> Dict[str,str]:
+    """Bind worker i to its own visible GPU (i < number of GPUs) or, without CUDA, to a disjoint slice of CPU cores."""
+    env = dict(os.environ)
+    vis = visible_gpus()
+    if vis:
+        env["CUDA_VISIBLE_DEVICES"] = vis[i]
+    else:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        per = max(1, len(cores) // n)
+        mine = cores[i*per:(i+1)*per] or cores[-per:]
+        env["OVERSEER_CPUSET"] = ",".join(map(str, mine))
+        env["OMP_NUM_THREADS"] = env["MKL_NUM_THREADS"] = str(len(mine))
+    return env
+
+def label_shard_worker(i: int, n: int) -> int:
+    """Entry point of `training_cli.py --label-shard i/n`; resumes from the shard's own seen-file and checkpoint."""
+    if not 0 <= i < n: print(f"Bad shard {i}/{n}"); return 2
+    cpus = os.environ.get("OVERSEER_CPUSET")
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {int(c) for c in cpus.split(",")})
+    safe_imports()
+    if not CFG.prompts_clean_csv.exists(): print("No prompts. Run [3] Clean first."); return 2
+    paths = shard_paths(i, n); CFG.shards_dir.mkdir(parents=True, exist_ok=True)
+    CFG.dataset_jsonl, CFG.seen_index, CFG.queue_ckpt = paths["dataset"], paths["seen"], paths["ckpt"]
+    CFG.dataset_index = paths["index"]
+    CFG.seen_file = paths["seen"].with_suffix(".txt")   # only read if an older run left a text seen-file
+    allp = load_clean_prompts()
+    PROMPTS[:] = [p for p in allp if shard_of(p, n) == i]
+    print(f"Shard {i}/{n}: {len(PROMPTS)} of {len(allp)} prompts | CUDA_VISIBLE_DEVICES="
+          f"{os.environ.get('CUDA_VISIBLE_DEVICES','-')} | cpus={cpus or '-'}")
+    done = action_label() if PROMPTS else True
+    if done: paths["done"].write_text(str(int(time.time())), encoding="utf-8")
+    return 0 if done else 1
+
+def merge_shards(n: int) -> Optional[Path]:
+    """
+    Fold shard outputs into CFG.dataset_jsonl. Deterministic for a given set of inputs: rows are ordered by
+    the base prompt's position in prompts_clean.csv, then variation; duplicates by (canonical key, variation)
+    keep the first copy in (main dataset, shard 0..n-1, line) order. Lines are copied byte-for-byte.
+    """
+    safe_imports()
+    import orjson
+    order: Dict[str,int] = {}
+    if CFG.prompts_clean_csv.exists():
+        for idx, p in enumerate(load_clean_prompts()):
+            order.setdefault(canonical_key(p), idx)
+    sources = [CFG.dataset_jsonl] + [shard_paths(i, n)["dataset"] for i in range(n)]
+    best: Dict[tuple,tuple] = {}
+    stats = {"rows": 0, "dups": 0, "torn": 0}
+    for src_i, src in enumerate(sources):
+        if not src.exists(): continue
+        with open(src, "rb") as f:
+            off = 0
+            for line in f:
+                start, off = off, off + len(line)
+                if not line.endswith(b"\n"): stats["torn"] += 1; continue    # partial tail of a crashed shard
+                try: rec = orjson.loads(line); prompt = rec["prompt"]
+                except Exception: stats["torn"] += 1; continue
+                stats["rows"] += 1
+                m = _VARIATION.search(prompt.strip())
+                var = rec.get("variation")   # sampled variations share the base prompt text
+                key = (canonical_key(prompt), int(var) if var is not None else int(m.group(1)) if m else 0)
+                if key in best: stats["dups"] += 1; continue
+                best[key] = (order.get(key[0], len(order)), key[0], key[1], src_i, start, len(line))
+    if not best: print("Nothing to merge."); return None
+    handles = {i: open(src, "rb") for i, src in enumerate(sources) if src.exists()}
+    tmp = CFG.dataset_jsonl.with_suffix(".merge.tmp")
+    try:
+        with open(tmp, "wb") as out:
+            for _, _, _, src_i, start, size in sorted(best.values()):
+                f = handles[src_i]; f.seek(start); out.write(f.read(size))
+            out.flush(); os.fsync(out.fileno())
+    finally:
+        for f in handles.values(): f.close()
+    os.replace(tmp, CFG.dataset_jsonl)
+
+    import numpy as np
+    seen = SeenIndex(CFG.seen_index, CFG.seen_file)
+    for i in range(n):
+        src = shard_paths(i, n)["seen"]
+        if src.exists() or src.with_suffix(".txt").exists():
+            sh = SeenIndex(src, src.with_suffix(".txt")); seen.base = np.union1d(seen.base, sh.hashes()); sh.close()
+    seen.compact(); n_seen = len(seen); seen.close()
+    print(f"Merged {len(best)} rows from {n} shards (+ existing dataset) → {CFG.dataset_jsonl} | "
+          f"{stats['dups']} duplicates dropped, {stats['torn']} torn/invalid lines skipped, {n_seen} seen prompts")
+    return CFG.dataset_jsonl
+
+def action_label_sharded():
+    """Run label_shards workers in parallel, then merge. Re-running restarts only shards without a .done marker."""
+    safe_imports()
+    n = max(1, CFG.label_shards)
+    gpus = visible_gpus()
+    if gpus and n > len(gpus):   # two teachers sized for a whole GPU each would OOM on a shared one
+        print(f"label_shards={n} but only {len(gpus)} GPU(s) visible — set label_shards ≤ {len(gpus)} "
+              f"(one teacher per GPU) or use [5]."); return
+    CFG.shards_dir.mkdir(parents=True, exist_ok=True)
+    if not CFG.prompts_clean_csv.exists(): print("No prompts. Run [3] Clean first."); return
+    src_mtime = CFG.prompts_clean_csv.stat().st_mtime    # a re-clean invalidates .done markers
+    todo = [i for i in range(n) if not (shard_paths(i, n)["done"].exists()
+                                        and shard_paths(i, n)["done"].stat().st_mtime >= src_mtime)]
+    procs = {}
+    for i in todo:
+        paths = shard_paths(i, n)
+        log = open(paths["log"], "a", encoding="utf-8")
+        procs[i] = (subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "--label-shard", f"{i}/{n}"],
+                                     env=shard_env(i, n), stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL), log)
+        print(f"  shard {i}/{n} → pid {procs[i][0].pid} | log {paths['log']}")
+    failed = []
+    try:
+        for i, (proc, log) in procs.items():
+            rc = proc.wait(); log.close()
+            print(f"  shard {i}/{n} exited {rc}")
+            if rc != 0: failed.append(i)
+    except KeyboardInterrupt:
+        for proc, _ in procs.values(): proc.terminate()
+        print("Interrupted — shards resume from their own checkpoints on the next run."); return
+    if failed:
+        print("Shards not finished:", failed, "— re-run [5a] (finished shards are skipped) or "
+              f"`python {Path(__file__).name} --label-shard i/{n}` for one shard, then [5b] to merge.")
+        return
+    merge_shards(n)
+
+def action_teacher_cache():
+    cache = teacher_cache()
+    rows = cache.stats()
+    if not rows: print("Teacher cache empty:", CFG.teacher_cache_db); return
+    for tid, n, nb in rows: print(f"  {tid}: {n} entries, {(nb or 0)/1e6:.1f} MB")
+    print(cache.report())
+    choice = input("Invalidate: teacher id | 'stale' (old personas) | Enter to skip: ").strip()
+    if not choice: return
+    if choice == "stale":
+        current = dict(reversed(teacher_profile(k)) for k in TEACHER_ORDER)
+        n = cache.invalidate(stale_persona_of=current)
+    else:
+        n = cache.invalidate(teacher_id=choice)
+    print(f"🗑 Removed {n} cached responses")
 
 def action_toggle_mode():
     CFG.training_mode = "full" if CFG.training_mode == "qlora" else "qlora"
@@ -619,38 +2838,55 @@ def action_train():
     safe_imports()
     import orjson
     if not CFG.dataset_jsonl.exists(): print("Dataset not found:", CFG.dataset_jsonl); return
-    rows = [orjson.loads(l) for l in open(CFG.dataset_jsonl,"r",encoding="utf-8")]
-    msgs = [build_sft_messages(r) for r in rows if ("envelope" in r and all(k in r["envelope"] for k in ["tag","ok","code","md","data","next"]))]
-    print("Records for SFT:", len(msgs))
-    if not msgs: print("No valid records."); return
+    if CFG.train_filter:
+        rows = [(r.get("prompt"), r.get("reasoning_md"), r.get("eye_tag"), orjson.dumps(r.get("envelope")).decode("utf-8"))
+                for r in query_dataset(**parse_filter(CFG.train_filter))]
+        print(f"Filter [{CFG.train_filter}]: {len(rows)} rows")
+    else:
+        cols = read_dataset(["offset", "prompt", "reasoning_md", "eye_tag", "envelope"]).to_pydict()
+        rows = list(zip(cols["prompt"], cols["reasoning_md"], cols["eye_tag"], cols["envelope"]))
 
-    from transformers import AutoTokenizer, AutoModelForCausalLM, DataCollatorForLanguageModeling, TrainingArguments
-    from trl import SFTTrainer
+    from transformers import AutoTokenizer, AutoModelForCausalLM, TrainingArguments
     tok_s = AutoTokenizer.from_pretrained(CFG.student_id, trust_remote_code=True)
     if tok_s.pad_token is None: tok_s.pad_token = tok_s.eos_token
-
-    def messages_to_text(messages):
-        if hasattr(tok_s,"apply_chat_template"):
-            return tok_s.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
-        parts=[]; 
-        for m in messages: parts.append(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n")
-        return "".join(parts)
-
-    texts = [{"text": messages_to_text(m)} for m in msgs]
-    from datasets import Dataset
-    ds = Dataset.from_list(texts).train_test_split(test_size=0.05, seed=42)
-
-    coll = DataCollatorForLanguageModeling(tokenizer=tok_s, mlm=False)
+    table, idx, cst = sft_token_cache(tok_s, rows)
+    print(f"Records for SFT: {cst['rows']} ({cst['invalid']} without a full envelope) | token cache: "
+          f"{cst['cached']} cached, {cst['tokenized']} tokenized in {cst['tokenize_s']:.1f}s → {cst['cache']}")
+    if not idx: print("No valid records."); return
+    MODELS.unload_all()   # training wants the whole device
+
+    tr, ev = split_train_eval(len(idx))
+    tr, ev = [idx[i] for i in tr], [idx[i] for i in ev]
+    length = table.column("length").to_numpy()
+    pack = CFG.sft_packing and packed_attention_supported()
+    if CFG.sft_packing and not pack: print("⚠ This transformers can't isolate packed examples — training unpacked.")
+    if pack:
+        packs = pack_examples(tr, length, CFG.max_seq_len)
+        train_ds, eval_ds = SFTPacks(table, packs), SFTPacks(table, pack_examples(ev, length, CFG.max_seq_len))
+        coll = SFTPackCollator()
+    else:
+        packs = None
+        train_ds, eval_ds = SFTRows(table, tr), SFTRows(table, ev)
+        coll = SFTCollator(tok_s.pad_token_id)
+    print(padding_report(length, tr, packs, CFG.per_device_bsz, CFG.max_seq_len))
+    sampler = None
+    if CFG.sft_token_budget > 0:
+        items = [sum(int(length[j]) for j in p) for p in packs] if pack else length[tr]
+        sampler = TokenBudgetSampler(items, CFG.sft_token_budget); print(sampler.report())
+    import inspect
+    # 3% warmup: warmup_ratio up to transformers 4.x, a fractional warmup_steps from 5.0 (which dropped warmup_ratio)
+    warmup = ({"warmup_ratio": 0.03} if "warmup_ratio" in inspect.signature(TrainingArguments.__init__).parameters
+              else {"warmup_steps": 0.03})
     args = TrainingArguments(
         output_dir=str(CKPTS),
         per_device_train_batch_size=CFG.per_device_bsz,
         gradient_accumulation_steps=CFG.grad_accum,
         learning_rate=CFG.lr,
         num_train_epochs=CFG.sft_epochs,
-        warmup_ratio=0.03,
         logging_steps=20,
         save_steps=200, save_total_limit=3,
-        evaluation_strategy="steps", eval_steps=200,
+        eval_strategy="steps", eval_steps=200,
+        **warmup,
         bf16=True if __import__('torch').cuda.is_available() else False,
         gradient_checkpointing=True, report_to="none",
     )
@@ -673,10 +2909,8 @@ def action_train():
         lora = LoraConfig(r=32, lora_alpha=16, lora_dropout=0.05, bias="none",
                           target_modules=["q_proj","k_proj","v_proj","o_proj","gate_proj","up_proj","down_proj"])
         student = get_peft_model(student, lora); student.print_trainable_parameters()
-        trainer = SFTTrainer(model=student, tokenizer=tok_s,
-                             train_dataset=ds["train"], eval_dataset=ds["test"],
-                             dataset_text_field="text", max_seq_length=CFG.max_seq_len,
-                             data_collator=coll, args=args)
+        trainer = sft_trainer(sampler, model=student, args=args, train_dataset=train_ds, eval_dataset=eval_ds,
+                              data_collator=coll)
         trainer.train()
         out = OUTD / "student_lora_final"
         trainer.save_model(str(out)); tok_s.save_pretrained(str(out))
@@ -688,10 +2922,8 @@ def action_train():
             torch_dtype=__import__('torch').bfloat16, trust_remote_code=True
         )
         student.gradient_checkpointing_enable()
-        trainer = SFTTrainer(model=student, tokenizer=tok_s,
-                             train_dataset=ds["train"], eval_dataset=ds["test"],
-                             dataset_text_field="text", max_seq_length=CFG.max_seq_len,
-                             data_collator=coll, args=args)
+        trainer = sft_trainer(sampler, model=student, args=args, train_dataset=train_ds, eval_dataset=eval_ds,
+                              data_collator=coll)
         trainer.train()
         out = OUTD / "student_full_ft"
         trainer.save_model(str(out)); tok_s.save_pretrained(str(out))
@@ -703,6 +2935,7 @@ def action_merge():
     from peft import PeftModel
     out = OUTD / "student_lora_final"
     if not out.exists(): print("LoRA not found:", out); return
+    MODELS.unload("student")   # eval should pick up the merged weights next time
     try:
         base = AutoModelForCausalLM.from_pretrained(CFG.student_id, device_map="auto",
                     torch_dtype=__import__('torch').bfloat16, trust_remote_code=True)
@@ -718,18 +2951,18 @@ def action_merge():
 def action_eval():
     safe_imports()
     from transformers import AutoTokenizer, AutoModelForCausalLM
-    tok_s = AutoTokenizer.from_pretrained(CFG.student_id, trust_remote_code=True)
-    if tok_s.pad_token is None: tok_s.pad_token = tok_s.eos_token
-    try:
+    def loader():
         dest = OUTD / "student_merged"
-        if dest.exists():
-            mdl = AutoModelForCausalLM.from_pretrained(str(dest), device_map="auto",
-                    torch_dtype=__import__('torch').bfloat16, trust_remote_code=True)
-        else:
-            mdl = AutoModelForCausalLM.from_pretrained(CFG.student_id, device_map="auto",
-                    torch_dtype=__import__('torch').bfloat16, trust_remote_code=True)
+        source = str(dest) if dest.exists() else CFG.student_id
+        tok = AutoTokenizer.from_pretrained(CFG.student_id, trust_remote_code=True)
+        mdl = AutoModelForCausalLM.from_pretrained(source, device_map="auto",
+                torch_dtype=__import__('torch').bfloat16, trust_remote_code=True)
+        return tok, mdl, source
+    try:
+        tok_s, mdl = MODELS.get("student", loader)
     except Exception as e:
         print("Load student failed:", e); return
+    if tok_s.pad_token is None: tok_s.pad_token = tok_s.eos_token
 
     def apply_template(tok, messages, add_generation_prompt=True):
         if hasattr(tok, "apply_chat_template"):
@@ -751,10 +2984,14 @@ def action_eval():
         ]
         chat = apply_template(tok_s, messages, add_generation_prompt=True)
         inputs = tok_s(chat, return_tensors="pt").to(mdl.device)
+        n_in = inputs["input_ids"].shape[1]; kw = {}
+        if CFG.constrained_json:
+            from transformers import LogitsProcessorList
+            kw["logits_processor"] = LogitsProcessorList([JsonConstraint(GenTrace(tok_s, n_in, [_think_mode(chat)]), CFG.json_topk)])
         with __import__('torch').inference_mode():
             out = mdl.generate(**inputs, max_new_tokens=350, do_sample=False, temperature=0.0,
-                               pad_token_id=tok_s.eos_token_id, eos_token_id=tok_s.eos_token_id)
-        dec = tok_s.decode(out[0], skip_special_tokens=False)
+                               pad_token_id=tok_s.eos_token_id, eos_token_id=tok_s.eos_token_id, **kw)
+        dec = tok_s.decode(out[0][n_in:], skip_special_tokens=False)
         res = extract_reasoning_and_json(dec)
         print("\nPROMPT:", p)
         print("🧠", (res["reasoning"] or "")[:300])
@@ -766,14 +3003,21 @@ MENU = """
 [1] Setup isolated environment (installs into /mnt/data/overseer_pkgs)
 [2] Hugging Face login
 [3] Clean & deduplicate prompts (4 CSVs in /mnt/data)
+[3a] Bench: python vs arrow clean engine (rows/s)
 [4] Dry-run (2 prompts) — verify JSON
+[4a] Teacher cache — stats / invalidate by teacher
+[4b] Bench: persona prefix KV cache (identical outputs + prefill savings)
+[4c] Bench: grammar-constrained vs free JSON decoding (invalid rate + tok/s)
 [5] Label & augment (resume + checkpoints)
+[5a] Sharded label & augment (label_shards worker processes → merge)
+[5b] Merge label shards → dataset JSONL
 [6] Train student (QLO﻿RA)
 [6a] Toggle training mode (QLO﻿RA/FULL)
 [7] Merge LoRA → full student (optional)
 [8] Evaluate student (reasoning + JSON)
 [9] Export & quantize (HF full + AWQ 4-bit + try GGUF Q4/Q5/Q8)
 [10] Summaries (dataset stats → MD + JSON)
+[10a] Query dataset index (eye_tag / lang / teacher_id / flag … → JSONL)
 [11] Quit
 """
 
@@ -785,14 +3029,21 @@ def main():
         if   choice == "1":   action_setup()
         elif choice == "2":   action_hf_login()
         elif choice == "3":   action_clean()
+        elif choice == "3a":  action_bench_clean()
         elif choice == "4":   action_dryrun()
+        elif choice == "4a":  action_teacher_cache()
+        elif choice == "4b":  action_bench_prefix_cache()
+        elif choice == "4c":  action_bench_constrained()
         elif choice == "5":   action_label()
+        elif choice == "5a":  action_label_sharded()
+        elif choice == "5b":  merge_shards(max(1, CFG.label_shards))
         elif choice == "6":   action_train()
         elif choice == "6a":  action_toggle_mode()
         elif choice == "7":   action_merge()
         elif choice == "8":   action_eval()
         elif choice == "9":   action_export_quant()
         elif choice == "10":  action_summary()
+        elif choice == "10a": action_query_dataset()
         elif choice == "11" or choice.startswith("q"): break
         else: print("Unknown choice.")
         print("\n--- done ---\n")
@@ -803,4 +3054,7 @@ if __name__ == "__main__":
     except Exception:
         print("Installing isolated packages …")
         ensure_pkgs(); safe_imports()
+    if len(sys.argv) == 3 and sys.argv[1] == "--label-shard":
+        i, n = (int(x) for x in sys.argv[2].split("/"))
+        sys.exit(label_shard_worker(i, n))
     main()